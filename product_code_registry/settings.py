@@ -126,3 +126,33 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Product code registry
+
+# Keep the latest pending edit of each field in the PendingEdit table and
+# read the unconfirmed edits overlay from it.
+MATERIALIZE_PENDING_EDITS = False
+
+# Keep the serialized representation of every product in the ProductDocument
+# table and serve product reads without unconfirmed edits from it.
+MATERIALIZE_PRODUCT_DOCUMENTS = False
+
+# Serialize products from values_list() rows of each OB table instead of
+# model instances.
+SERIALIZE_PRODUCT_VALUES = False
+
+# Serialized products served by the detail endpoints. A file based cache is
+# shared by every server process and by the management commands, so that an
+# import or an edit invalidates the entries all of them read.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'products': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'products',
+        'TIMEOUT': 24 * 60 * 60,
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+}
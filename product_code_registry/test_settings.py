@@ -0,0 +1,23 @@
+"""
+Django settings for running the tests of product_code_registry.
+
+    python manage.py test --settings=product_code_registry.test_settings
+"""
+
+from product_code_registry.settings import *  # noqa: F401,F403
+
+# The migrations of the server app are made locally rather than tracked, so
+# the test database creates its tables straight from the models.
+MIGRATION_MODULES = {'server': None}
+
+# Keep the product cache of the tests apart from the file based one of the
+# server processes.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'products': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'products',
+    },
+}
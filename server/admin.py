@@ -1,6 +1,19 @@
 from django.apps import apps
 from django.contrib import admin
 
+from server import models
+
+
+@admin.register(models.Edit)
+class EditAdmin(admin.ModelAdmin):
+    list_display = ('ModelName', 'InstanceID', 'FieldName', 'FieldValue', 'FieldValueOld',
+                    'Status', 'Type', 'DateSubmitted')
+    list_filter = ('Status', 'Type', 'ModelName')
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_values()
+
 
 for m in apps.all_models['server'].values():
-    admin.site.register(m)
+    if not admin.site.is_registered(m):
+        admin.site.register(m)
@@ -0,0 +1,199 @@
+import dataclasses
+import functools
+import hashlib
+import time
+from urllib.parse import quote
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_save, pre_delete
+from django.utils.http import quote_etag
+from rest_framework.utils.encoders import JSONEncoder
+
+import server.ob_item_types as obit
+from server import documents
+from server import fieldsets
+from server import models
+
+
+CACHE_ALIAS = 'products'
+
+
+def product_cache():
+    return caches[CACHE_ALIAS]
+
+
+@dataclasses.dataclass(frozen=True)
+class CachedProduct:
+    """A serialized product with the validators for conditional requests."""
+    data: dict
+    etag: str
+    last_modified: int  # seconds since the epoch
+
+
+def get_product(lookup_field, value, unconfirmed_edits, fieldset=fieldsets.ALL):
+    """The cached representation of the product ``lookup_field=value``, or None.
+
+    A hit is answered without touching the database. Each entry is stamped
+    with the generation of its product it was cached in, which
+    ``invalidate_products`` moves on whenever anything in the product's OB
+    tree, or an edit of it, is written. Entries of an older generation, or
+    of a product whose generation was evicted, are misses.
+    """
+    cache = product_cache()
+    entry = cache.get(_product_key(lookup_field, value, unconfirmed_edits, fieldset))
+    if entry is None:
+        return None
+    pk, generation, cached = entry
+    current = cache.get(_generation_key(pk))
+    if current is None or current != generation:
+        return None
+    return cached
+
+
+def product_generation(pk):
+    """The current generation of the product ``pk``, or None if it could not be stored.
+
+    Read it before the product's rows: an entry cached with it then misses
+    if the product is invalidated while it is being serialized.
+    """
+    cache = product_cache()
+    cache.add(_generation_key(pk), _new_generation(), timeout=None)
+    return cache.get(_generation_key(pk))
+
+
+def cache_product(pk, generation, lookup_field, value, unconfirmed_edits, data, fieldset=fieldsets.ALL):
+    """Cache ``data``, read after ``product_generation(pk)`` returned ``generation``, see ``get_product``."""
+    data = dict(data)
+    etag = quote_etag(hashlib.sha256(JSONEncoder().encode(data).encode()).hexdigest())
+    cached = CachedProduct(data, etag, int(time.time()))
+    if generation is not None:
+        key = _product_key(lookup_field, value, unconfirmed_edits, fieldset)
+        product_cache().set(key, (pk, generation, cached))
+    return cached
+
+
+def invalidate_products(pks):
+    """Move the products ``pks`` to a new generation, so none of their cached entries hit again.
+
+    Whichever lookup and fieldset an entry was cached under, it is checked
+    against the generation of its product, so invalidating needs no record
+    of the entries that the cache could have culled.
+    """
+    product_cache().set_many({_generation_key(pk): _new_generation() for pk in pks}, timeout=None)
+
+
+def _product_key(lookup_field, value, unconfirmed_edits, fieldset):
+    key = f'product:{lookup_field}:{quote(str(value))}:{int(unconfirmed_edits)}'
+    if fieldset != fieldsets.ALL:
+        key += ':' + hashlib.sha256(repr(fieldset).encode()).hexdigest()
+    return key
+
+
+def _generation_key(pk):
+    return f'product-generation:{pk}'
+
+
+def _new_generation():
+    return uuid.uuid4().hex
+
+
+def products_containing(model_name, pk):
+    """The ids of the products whose OB tree contains row ``pk`` of ``model_name``.
+
+    The tree is walked upwards, through the OB objects and arrays that use
+    ``model_name``, so a Dimension leads to the products (and the ProdCell of
+    a ProdModule) it belongs to.
+    """
+    pks = set()
+    seen = set()
+    pending = [(model_name, pk)]
+    while len(pending) > 0:
+        model_name, pk = pending.pop()
+        if (model_name, pk) in seen:
+            continue
+        seen.add((model_name, pk))
+        model = models.django_model(model_name)
+        if issubclass(model, models.Product):
+            pks.add(pk)
+            # A product is used by other OB objects under the name of its
+            # subclass, e.g. the ProdCell of a ProdModule, while its OB
+            # objects belong to whichever class in the hierarchy declares them.
+            pending.extend((m.__name__, pk) for m in _product_classes())
+        for owner, field in _object_owners(model_name):
+            owner_pks = models.django_model(owner).objects.filter(**{field: pk}).values_list('pk', flat=True)
+            pending.extend((owner, p) for p in owner_pks)
+        array_parents = _array_parents(model_name)
+        if len(array_parents) > 0:
+            row = model.objects.filter(pk=pk).values(*array_parents).first()
+            if row is not None:
+                pending.extend((parent, p) for parent, p in row.items() if p is not None)
+    return pks
+
+
+@functools.cache
+def _product_classes():
+    return (models.Product,) + models.concrete_subclasses(models.Product)
+
+
+@functools.cache
+def _object_owners(model_name):
+    """The ``(model name, field name)`` of the OB objects that have a ``model_name``."""
+    return tuple(
+        (owner, model_name) for owner in sorted(models.OB_OBJECT_MODELS)
+        if model_name in obit.objects_of_ob_object(owner)
+    )
+
+
+@functools.cache
+def _array_parents(model_name):
+    """The OB objects ``model_name`` is an array item of, named as its foreign keys."""
+    return obit.ob_object_usage_as_array(model_name, models.OB_OBJECT_MODELS)
+
+
+def invalidate_ob_instance(sender, instance, **kwargs):
+    invalidate_on_commit(products_containing(sender.__name__, instance.pk))
+
+
+def invalidate_edit(sender, instance, **kwargs):
+    # Product documents leave out unconfirmed edits, so only the cache is stale.
+    pks = products_containing(instance.ModelName, instance.InstanceID)
+    invalidate_on_commit(pks, refresh_documents=False)
+
+
+def invalidate_on_commit(pks, refresh_documents=True):
+    """Invalidate the products ``pks`` once the current transaction commits.
+
+    Their product documents are refreshed first, while materialized.
+    Invalidating before the commit would let a concurrent read cache the old
+    rows again.
+    """
+    if len(pks) > 0:
+        transaction.on_commit(lambda: _products_changed(pks, refresh_documents))
+
+
+def _products_changed(pks, refresh_documents):
+    if refresh_documents and settings.MATERIALIZE_PRODUCT_DOCUMENTS:
+        documents.refresh_documents(pks)
+    invalidate_products(set(pks) | products_sharing_prod_code(pks))
+
+
+def products_sharing_prod_code(pks):
+    """The ids of the products with the same normalized product code as one of the products ``pks``.
+
+    A product code lookup cached while it found a single product must miss
+    once another product has the code, so it is answered as ambiguous.
+    """
+    codes = models.Product.objects.filter(pk__in=pks).exclude(ProdCodeNormalized='').values('ProdCodeNormalized')
+    return set(models.Product.objects.filter(ProdCodeNormalized__in=codes).values_list('pk', flat=True))
+
+
+def connect_signals():
+    for m in models.OB_MODELS:
+        post_save.connect(invalidate_ob_instance, sender=models.django_model(m))
+        pre_delete.connect(invalidate_ob_instance, sender=models.django_model(m))
+    for m in ('Edit',) + models.EDIT_MODELS:
+        post_save.connect(invalidate_edit, sender=models.django_model(m))
+        pre_delete.connect(invalidate_edit, sender=models.django_model(m))
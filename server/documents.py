@@ -0,0 +1,29 @@
+from django.db import transaction
+
+from server import exports
+from server import models
+from server import serializers
+
+
+def refresh_documents(pks):
+    """Reserialize the documents of the products ``pks``, dropping those of deleted products."""
+    pks = list(pks)
+    with transaction.atomic():
+        models.ProductDocument.objects.filter(Product__in=pks).delete()
+        for chunk in exports.product_chunks(models.Product.objects.filter(pk__in=pks)):
+            models.ProductDocument.objects.bulk_create(product_documents(chunk))
+
+
+def rebuild_documents():
+    with transaction.atomic():
+        models.ProductDocument.objects.all().delete()
+        for chunk in exports.product_chunks(models.Product.objects.all()):
+            models.ProductDocument.objects.bulk_create(product_documents(chunk))
+
+
+def product_documents(products):
+    context = dict(unconfirmed_edits=False)
+    return [
+        models.ProductDocument(Product_id=p.pk, Document=serializers.Product(p, context=context).data)
+        for p in products
+    ]
@@ -0,0 +1,76 @@
+from django.conf import settings
+from django.db.models import Q
+
+import server.ob_item_types as obit
+from server import models
+
+
+def ob_tree_instances(model, ids):
+    """Yield ``(model name, ids)`` for every OB table under the rows ``ids`` of ``model``.
+
+    ``ids`` may be a list of primary keys or a ``values()`` queryset, and the
+    ids yielded for the nested OB objects and arrays are subqueries built on
+    top of it, so the whole tree can be matched in a single SQL statement.
+    Multi-table subclasses of ``model`` (e.g. ProdBattery for Product) share
+    its primary keys and are walked as well.
+    """
+    yield from _ob_subtree_instances(model._meta.object_name, ids)
+    for subclass in models.concrete_subclasses(model):
+        yield from ob_tree_instances(subclass, ids)
+
+
+def _ob_subtree_instances(model_name, ids):
+    yield model_name, ids
+    if obit.get_schema_type(model_name) is not obit.OBType.Object:
+        return
+    model = models.django_model(model_name)
+    for o in obit.objects_of_ob_object(model_name):
+        yield from _ob_subtree_instances(o, model.objects.filter(pk__in=ids).values(o))
+    for _, singular in obit.arrays_of_ob_object(model_name):
+        children = models.django_model(singular).objects.filter(**{f'{model_name}__in': ids})
+        yield from _ob_subtree_instances(singular, children.values('pk'))
+
+
+class EditOverlay:
+    """The latest pending Update edits of a page of OB objects and everything under them.
+
+    All edits are fetched by ``load`` in one query, after which each
+    serializer picks its own ``(ModelName, InstanceID)`` slice with
+    ``edits_for``.
+    """
+
+    def __init__(self, edits):
+        self._edits = {}
+        for e in edits:
+            self._edits.setdefault((e.ModelName, e.InstanceID), {})[e.FieldName] = e.FieldValue
+
+    @classmethod
+    def load(cls, model, ids):
+        ids = list(ids)
+        if len(ids) == 0:
+            return cls(())
+        # Start from the top of a multi-table hierarchy so that loading for a
+        # ProdBattery also covers the edits of its Product part.
+        parents = model._meta.get_parent_list()
+        if len(parents) > 0:
+            model = parents[-1]
+        instances = Q()
+        for model_name, instance_ids in ob_tree_instances(model, ids):
+            instances |= Q(ModelName=model_name, InstanceID__in=instance_ids)
+        if settings.MATERIALIZE_PENDING_EDITS:
+            pending = (
+                models.PendingEdit.objects
+                .filter(instances)
+                .select_related('Edit', *(f'Edit__{a}' for a in models.EDIT_VALUE_ACCESSORS))
+            )
+            return cls(p.Edit for p in pending)
+        edits = (
+            models.Edit.objects
+            .filter(instances)
+            .latest_pending_updates()
+            .with_values()
+        )
+        return cls(edits)
+
+    def edits_for(self, model_name, pk):
+        return self._edits.get((model_name, pk), {})
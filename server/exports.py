@@ -0,0 +1,96 @@
+import csv
+
+from rest_framework.utils.encoders import JSONEncoder
+
+import server.ob_item_types as obit
+from server import fieldsets
+from server import models
+from server import prefetch
+from server import serializers
+from server.edits import EditOverlay
+
+
+EXPORT_CHUNK_SIZE = 500
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def product_chunks(queryset, chunk_size=EXPORT_CHUNK_SIZE, fieldset=fieldsets.ALL):
+    """Yield the products of ``queryset`` a chunk at a time, by keyset on id.
+
+    Each chunk is a separate, fully planned query, so only one chunk of
+    products and their OB trees is held in memory at a time.
+    """
+    queryset = prefetch.plan_queryset(queryset.order_by('id'), fieldset)
+    last_id = 0
+    while True:
+        chunk = list(queryset.filter(id__gt=last_id)[:chunk_size])
+        if len(chunk) == 0:
+            return
+        yield chunk
+        last_id = chunk[-1].id
+
+
+def serialized_products(queryset, context, chunk_size=EXPORT_CHUNK_SIZE):
+    for chunk in product_chunks(queryset, chunk_size, context.get('fieldset', fieldsets.ALL)):
+        chunk_context = dict(context)
+        if chunk_context['unconfirmed_edits']:
+            chunk_context['edit_overlay'] = EditOverlay.load(models.Product, (p.pk for p in chunk))
+        for p in chunk:
+            yield serializers.Product(p, context=chunk_context).data
+
+
+def ndjson_rows(products):
+    encoder = JSONEncoder()
+    for p in products:
+        yield encoder.encode(p) + '\n'
+
+
+def csv_rows(products):
+    """Flatten each product to one CSV row.
+
+    OB elements become one column per primitive (e.g. ``Dimension.Height.Value``)
+    and OB arrays are written as a single JSON-encoded column.
+    """
+    columns = product_csv_columns()
+    writer = csv.DictWriter(Echo(), fieldnames=columns, restval='', extrasaction='ignore')
+    yield writer.writeheader()
+    encoder = JSONEncoder()
+    for p in products:
+        yield writer.writerow(dict(_flatten(p, '', encoder)))
+
+
+def product_csv_columns():
+    columns = list(_ob_columns('Product', ''))
+    for subclass in models.concrete_subclasses(models.Product):
+        columns += (c for c in _ob_columns(subclass.__name__, '') if c not in columns)
+    return columns
+
+
+def _ob_columns(model_name, prefix):
+    for e in obit.elements_of_ob_object(model_name).values():
+        for p in e.primitives():
+            yield f'{prefix}{e.name}.{p.name}'
+    for o in obit.objects_of_ob_object(model_name):
+        yield from _ob_columns(o, f'{prefix}{o}.')
+    for plural, _ in obit.arrays_of_ob_object(model_name):
+        yield f'{prefix}{plural}'
+
+
+def _flatten(data, prefix, encoder):
+    for k, v in data.items():
+        if isinstance(v, dict):
+            yield from _flatten(v, f'{prefix}{k}.', encoder)
+        elif isinstance(v, list):
+            yield f'{prefix}{k}', encoder.encode(v)
+        else:
+            yield f'{prefix}{k}', v
+
+
+class Echo:
+    """A file-like object that hands back what is written to it."""
+
+    def write(self, value):
+        return value
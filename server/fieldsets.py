@@ -0,0 +1,64 @@
+import dataclasses
+
+
+@dataclasses.dataclass(frozen=True)
+class Fieldset:
+    """The part of an OB tree a response asks for with ``?fields=`` and ``?depth=``.
+
+    ``fields`` is None to output every OB element, object and array, or the
+    ``(name, fields)`` pairs of the ones to output, each with the fields
+    wanted under it in turn. ``depth`` limits how many levels of OB objects
+    and arrays are output. With ``omit_empty``, element primitives other
+    than Value that are None or blank are left out. Fieldsets are hashable,
+    so that the serialization plans and prefetches pruned to them are
+    compiled once.
+    """
+    fields: tuple | None = None
+    depth: int | None = None
+    omit_empty: bool = False
+
+    @classmethod
+    def parse(cls, fields='', depth=None, omit_empty=False):
+        """A fieldset from comma separated dotted paths, e.g. ``ProdCode,Dimension.Height``."""
+        tree = None
+        for path in fields.split(','):
+            names = [n for n in path.strip().split('.') if n != '']
+            if len(names) == 0:
+                continue
+            if tree is None:
+                tree = {}
+            node = tree
+            for n in names[:-1]:
+                node = node.setdefault(n, {})
+                if node is None:
+                    break  # a shorter path already asks for all of it
+            else:
+                node[names[-1]] = None
+        return cls(_freeze(tree), depth, omit_empty)
+
+    def includes(self, name):
+        return self.fields is None or name in dict(self.fields)
+
+    def child(self, name):
+        """The fieldset of the OB object or array ``name``, or None if it is not output."""
+        if not self.includes(name) or self.depth == 0:
+            return None
+        fields = None if self.fields is None else dict(self.fields)[name]
+        depth = None if self.depth is None else self.depth - 1
+        return Fieldset(fields, depth, self.omit_empty)
+
+    def element(self, name, primitive_names):
+        """The primitives of the OB element ``name`` to output."""
+        fields = None if self.fields is None else dict(self.fields)[name]
+        if fields is None:
+            return list(primitive_names)
+        return [p for p in primitive_names if p in dict(fields)]
+
+
+ALL = Fieldset()
+
+
+def _freeze(tree):
+    if tree is None:
+        return None
+    return tuple(sorted((name, _freeze(subtree)) for name, subtree in tree.items()))
@@ -0,0 +1,28 @@
+import django
+
+# The entry points of the processes uploads._read_in_workers reads
+# spreadsheets in. A spawned process imports this module to unpickle them
+# before Django is set up, so nothing of Django's models or the server app
+# may be imported here at module level.
+
+_chunks = None
+_stop = None
+
+
+def init_reader(chunks, stop):
+    global _chunks, _stop
+    django.setup()
+    _chunks = chunks
+    _stop = stop
+
+
+def read_chunks(path, spec, chunk_size, start_row):
+    from server import uploads
+
+    try:
+        for chunk in uploads.spreadsheet_chunks(path, spec, chunk_size, start_row):
+            if _stop.is_set():
+                return
+            _chunks.put(chunk)
+    finally:
+        _chunks.put(None)
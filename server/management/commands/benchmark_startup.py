@@ -0,0 +1,126 @@
+import os
+import statistics
+import subprocess
+import sys
+import timeit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+import server.ob_item_types as obit
+from server import models
+
+
+COLD_START_SCRIPT = '''
+import time
+start = time.perf_counter()
+{prelude}
+import django
+django.setup()
+import server.models
+print(time.perf_counter() - start)
+'''
+
+# Points the compiled index at a path that can be neither read nor written,
+# so the taxonomy is compiled from its JSON on every start, as it was before
+# the index.
+WITHOUT_INDEX_PRELUDE = '''
+import os
+from pathlib import Path
+import server.ob_item_types
+server.ob_item_types.OB_TAXONOMY_INDEX_FILEPATH = Path(os.devnull) / 'index.pickle'
+'''
+
+
+def scan_ob_object_usage_as_array(name, user_schema_names):
+    """The walk over the raw taxonomy ModelBase did for every model before the usage index."""
+    uses = []
+    for uname in user_schema_names:
+        for array_name in _raw_ob_object_properties(uname):
+            match obit.get_schema_defn(array_name):
+                case {'type': 'array', 'items': {'$ref': ref}}:
+                    if name == obit.get_ref_schema(ref):
+                        uses.append(uname)
+                case _:
+                    continue
+    return tuple(sorted(uses))
+
+
+def _raw_ob_object_properties(name):
+    match obit.get_schema_defn(name):
+        case {'allOf': [{'$ref': _}, {'properties': props}]}:
+            return props
+        case {'type': 'object', 'properties': props}:
+            return props
+        case _:
+            raise ValueError(f'Unknown OB object schema: "{name}"')
+
+
+def _raw_schema_type(name):
+    match obit.get_schema_defn(name):
+        case {'allOf': [{'$ref': ref}, _]}:
+            if obit.get_ref_schema(ref) in tuple(t.value for t in obit.TaxonomyElement):
+                return obit.OBType.Element
+            return obit.OBType.Object
+        case {'type': 'object'}:
+            return obit.OBType.Object
+        case {'type': 'array'}:
+            return obit.OBType.Array
+        case _:
+            raise ValueError(f'Unknown schema definition type: "{name}"')
+
+
+def scan_array_usages():
+    for name in models.OB_MODELS:
+        user_schemas = [m for m in models.OB_MODELS if _raw_schema_type(m) is not obit.OBType.Element]
+        scan_ob_object_usage_as_array(name, user_schemas)
+
+
+def indexed_array_usages():
+    for name in models.OB_MODELS:
+        obit.ob_object_usage_as_array(name, models.OB_OBJECT_MODELS)
+
+
+class Command(BaseCommand):
+    help = ('Compare cold starts of the server models, and the array usage lookups ModelBase makes, '
+            'with and without the compiled taxonomy index.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5,
+                            help='Number of fresh interpreters to start.')
+        parser.add_argument('--repeat', type=int, default=100,
+                            help='Number of times to resolve the array usages of every model.')
+
+    def handle(self, *args, runs, repeat, **options):
+        cold_starts = {}
+        for label, prelude in (('Without the index', WITHOUT_INDEX_PRELUDE), ('With the index', '')):
+            cold_starts[label] = statistics.median(self._cold_start(prelude) for _ in range(runs))
+            self.stdout.write(
+                f'Cold start (django.setup + server.models), {label.lower()}, over {runs} runs: '
+                f'median {cold_starts[label] * 1000:.1f} ms'
+            )
+        self._write_difference('Cold start', *cold_starts.values())
+
+        # Load the taxonomy JSON outside of the timings, as ModelBase found it loaded.
+        obit.get_schema_defn(models.OB_MODELS[0])
+        usages = {}
+        for label, fn in (('Full scan', scan_array_usages), ('Usage index', indexed_array_usages)):
+            usages[label] = timeit.timeit(fn, number=repeat) / repeat
+            self.stdout.write(
+                f'{label}: {usages[label] * 1000:.3f} ms to resolve the array usages of '
+                f'{len(models.OB_MODELS)} models'
+            )
+        self._write_difference('Array usages', *usages.values())
+
+    def _write_difference(self, label, before, after):
+        self.stdout.write(
+            f'{label}: {(before - after) * 1000:.1f} ms faster, {before / after:.1f}x'
+        )
+
+    def _cold_start(self, prelude=''):
+        result = subprocess.run(
+            [sys.executable, '-c', COLD_START_SCRIPT.format(prelude=prelude)],
+            cwd=settings.BASE_DIR, env=os.environ.copy(),
+            capture_output=True, text=True, check=True
+        )
+        return float(result.stdout.strip().splitlines()[-1])
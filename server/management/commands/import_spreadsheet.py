@@ -0,0 +1,50 @@
+from django.contrib import auth
+from django.core.management.base import BaseCommand, CommandError
+
+from server import uploads
+
+
+class Command(BaseCommand):
+    help = (
+        'Import CEC or vendor spreadsheets (xlsx or CSV), each described by one of the import specs, '
+        'e.g. "import_spreadsheet cec_battery batteries.xlsx cec_module modules.csv".'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('sheets', nargs='+', metavar='spec path')
+        parser.add_argument('--chunk-size', type=int, default=uploads.IMPORT_CHUNK_SIZE,
+                            help='Number of rows read, validated and committed at a time.')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of processes reading the spreadsheets in parallel.')
+        parser.add_argument('--incremental', action='store_true',
+                            help='Update the products imported before and skip the unchanged ones.')
+        parser.add_argument('--edits-by', metavar='USERNAME',
+                            help='With --incremental, submit changed values as pending edits by this user.')
+        parser.add_argument('--error-report', default='import_errors.csv', metavar='PATH',
+                            help='CSV file listing the rejected rows, only written if rows are rejected.')
+        parser.add_argument('--restart', action='store_true',
+                            help='Start over instead of resuming an interrupted import of the same files.')
+
+    def handle(self, *args, **options):
+        if len(options['sheets']) % 2 != 0:
+            raise CommandError('Give a spec and a path for every spreadsheet.')
+        sheets = []
+        for spec, path in zip(options['sheets'][::2], options['sheets'][1::2]):
+            if spec not in uploads.IMPORT_SPECS:
+                raise CommandError(f'Unknown import spec {spec!r}, choose from {", ".join(sorted(uploads.IMPORT_SPECS))}.')
+            sheets.append((path, uploads.IMPORT_SPECS[spec]))
+        submitted_by = None
+        if options['edits_by'] is not None:
+            if not options['incremental']:
+                raise CommandError('--edits-by needs --incremental.')
+            try:
+                submitted_by = auth.get_user_model().objects.get(username=options['edits_by'])
+            except auth.get_user_model().DoesNotExist:
+                raise CommandError(f'No user {options["edits_by"]!r}.')
+        counts = uploads.import_spreadsheets(sheets, options['chunk_size'], options['workers'],
+                                             options['incremental'], submitted_by, options['error_report'],
+                                             options['restart'])
+        self.stdout.write(f'{counts["created"]} products created, {counts["updated"]} updated, '
+                          f'{counts["unchanged"]} unchanged.')
+        if counts['rejected'] > 0:
+            self.stderr.write(f'{counts["rejected"]} rows rejected, see {options["error_report"]}.')
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from server import models
+
+
+class Command(BaseCommand):
+    help = 'Fill in the normalized product code of products saved before it existed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        products = models.Product.objects.only('pk', 'ModelName', 'ProdCode_Value', 'ProdCodeNormalized')
+        batch = []
+        updated = 0
+        for p in products.iterator(chunk_size=options['batch_size']):
+            normalized = models.normalize_prod_code(p.ProdCode_Value)
+            if p.ProdCodeNormalized != normalized:
+                p.ProdCodeNormalized = normalized
+                batch.append(p)
+            if len(batch) == options['batch_size']:
+                models.Product.objects.bulk_update(batch, ['ProdCodeNormalized'])
+                updated += len(batch)
+                batch = []
+        models.Product.objects.bulk_update(batch, ['ProdCodeNormalized'])
+        updated += len(batch)
+        self.stdout.write(f'{updated} product codes normalized.')
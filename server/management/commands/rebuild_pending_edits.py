@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from server import models
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the PendingEdit table from the Edit history.'
+
+    def handle(self, *args, **options):
+        models.PendingEdit.rebuild()
+        self.stdout.write(f'{models.PendingEdit.objects.count()} pending edits materialized.')
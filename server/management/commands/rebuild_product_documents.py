@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from server import documents
+from server import models
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the ProductDocument table from the OB tables.'
+
+    def handle(self, *args, **options):
+        documents.rebuild_documents()
+        self.stdout.write(f'{models.ProductDocument.objects.count()} product documents materialized.')
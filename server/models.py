@@ -1,12 +1,17 @@
 import enum
 
-from django.db import models
+from django.apps import apps
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Exists, OuterRef, Q
 from django.core import validators
 from django.contrib import auth
+from rest_framework.utils.encoders import JSONEncoder
 import server.ob_item_types as obit
 
 
 FOREIGN_KEY_KWARGS = dict(on_delete=models.DO_NOTHING)
+PROD_CODE_LEN = 16
 OB_MODELS = (
     'ACInput', 'ACOutput', 'Address', 'AlternativeIdentifier',
     'CertificationAgency', 'Contact', 'DCInput', 'DCOutput', 'Dimension',
@@ -17,10 +22,23 @@ OB_MODELS = (
     'ProdGlazing', 'ProdInstruction', 'ProdMeter', 'ProdModule', 'ProdName',
     'ProdOptimizer', 'ProdSpecification', 'ProdWire', 'Product', 'Warranty'
 )
+OB_OBJECT_MODELS = frozenset(m for m in OB_MODELS
+                             if obit.get_schema_type(m) is not obit.OBType.Element)
 EDIT_MODELS = (
-    'EditChar', 'EditDateTime', 'EditDecimal', 'EditPositiveInteger',
+    'EditChar', 'EditDate', 'EditDateTime', 'EditDecimal', 'EditPositiveInteger',
     'EditInteger', 'EditURL', 'EditUUID'
 )
+EDIT_VALUE_ACCESSORS = tuple(m.lower() for m in EDIT_MODELS)
+
+
+def django_model(model_name):
+    return apps.get_model('server', model_name)
+
+
+def concrete_subclasses(model):
+    """The multi-table subclasses of ``model``, e.g. ProdBattery for Product."""
+    return tuple(m for m in model.__subclasses__()
+                 if not m._meta.abstract and not m._meta.proxy)
 
 
 class ModelBase(models.base.ModelBase):
@@ -34,6 +52,7 @@ class ModelBase(models.base.ModelBase):
                 case _:
                     cls.add_ob_elements(name, attrs)
                     cls.add_ob_objects(name, attrs)
+                    cls.add_ob_indexes(name, attrs)
             cls.add_ob_array_usages(name, attrs)
         return super().__new__(cls, name, bases, attrs, **kwargs)
 
@@ -52,12 +71,38 @@ class ModelBase(models.base.ModelBase):
         for o in objects:
             attrs[o] = models.OneToOneField(o, on_delete=models.DO_NOTHING)
 
+    def add_ob_indexes(name, attrs):
+        """Index the Value fields of the OB elements in ``ob_indexes``.
+
+        Each entry is an element name, or a tuple of them for a composite
+        index, and is added to ``Meta.indexes``.
+        """
+        ob_indexes = attrs.get('ob_indexes', ())
+        if len(ob_indexes) == 0:
+            return
+        elements = attrs.get('ob_elements', None)
+        if elements is None:
+            elements = obit.elements_of_ob_object(name)
+        meta = attrs.setdefault('Meta', type('Meta', (), {}))
+        indexes = list(getattr(meta, 'indexes', []))
+        for entry in ob_indexes:
+            element_names = (entry,) if isinstance(entry, str) else tuple(entry)
+            fields = []
+            for e in element_names:
+                if e not in elements:
+                    raise ValueError(f'Unknown OB element in ob_indexes of "{name}": "{e}"')
+                value = next(p for p in elements[e].primitives() if p.name == 'Value')
+                fields.append(elements[e].model_field_name(value))
+            index_name = f'{name.lower()}_{"_".join(e.lower() for e in element_names)}_idx'
+            if len(index_name) > models.Index.max_name_length:
+                index_name = ''  # let Django name it
+            indexes.append(models.Index(fields=fields, name=index_name))
+        meta.indexes = indexes
+
     def add_ob_array_usages(name, attrs):
-        user_schemas = [m for m in OB_MODELS
-                        if obit.get_schema_type(m) is not obit.OBType.Element]
         arrays = attrs.get('ob_array_usages', None)
         if arrays is None:
-            arrays = obit.ob_object_usage_as_array(name, user_schemas)
+            arrays = obit.ob_object_usage_as_array(name, OB_OBJECT_MODELS)
         for a in arrays:
             attrs[a] = models.ForeignKey(a, **FOREIGN_KEY_KWARGS)
 
@@ -80,8 +125,87 @@ class Product(Model):
             max_length=obit.URL_LEN,
             validators=[validators.URLValidator()]
         ),
-        ProdCode=dict(max_length=16)
+        ProdCode=dict(max_length=PROD_CODE_LEN)
     )
+    ModelName = models.CharField(max_length=max(len(m) for m in OB_MODELS), blank=True, editable=False)
+    SourceHash = models.CharField(max_length=64, blank=True, editable=False)  # of the imported row
+    ProdCodeNormalized = models.CharField(max_length=PROD_CODE_LEN, blank=True, editable=False)  # see normalize_prod_code
+
+    # Filled in by populate_derived_fields.
+    derived_fields = ('ModelName', 'ProdCodeNormalized')
+
+    ob_indexes = (
+        ('ProdMfr', 'ProdCode'),  # also serves lookups on ProdMfr alone
+        'ProdCode',
+        'ProdType',
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['ModelName'], name='product_modelname_idx'),
+            # Serves exact and prefix (range) lookups of normalized codes.
+            models.Index(fields=['ProdCodeNormalized'], name='product_prodcodenorm_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.populate_derived_fields()
+        super().save(*args, **kwargs)
+
+    def populate_derived_fields(self):
+        """Fill in the columns derived from the product itself.
+
+        Called by ``save`` and by the bulk import paths, which bypass it.
+        """
+        if self.__class__ is not Product or self.ModelName == '':
+            self.ModelName = self.__class__.__name__
+        self.ProdCodeNormalized = normalize_prod_code(self.ProdCode_Value)
+
+    def subclass_instance(self):
+        """This product as its concrete model, e.g. its ProdBattery row."""
+        if self.__class__ is not Product or self.ModelName == Product.__name__:
+            return self
+        if self.ModelName != '':
+            return getattr(self, self.ModelName.lower())
+        # Rows saved before ModelName existed.
+        for subclass in concrete_subclasses(Product):
+            try:
+                return getattr(self, subclass._meta.model_name)
+            except subclass.DoesNotExist:
+                continue
+        return self
+
+
+def normalize_prod_code(code):
+    """``code`` upper-cased with everything but letters and digits removed, e.g. ``ABC123`` for ``abc-123 ``."""
+    if code is None:
+        return ''
+    return ''.join(c for c in code.upper() if c.isalnum())
+
+
+def similar_prod_codes(code, limit=5, min_prefix=3):
+    """Up to ``limit`` product codes that share the longest prefix of at least ``min_prefix`` with ``code``.
+
+    Both codes are compared normalized, and each prefix is matched with a
+    range of the normalized code index, so e.g. ``ABC-123-BK`` suggests
+    ``ABC 123`` without scanning the product table.
+    """
+    normalized = normalize_prod_code(code)
+    for n in range(len(normalized), min_prefix - 1, -1):
+        prefix = normalized[:n]
+        codes = list(
+            Product.objects
+            .filter(ProdCodeNormalized__gte=prefix, ProdCodeNormalized__lt=_prefix_successor(prefix))
+            .order_by('ProdCodeNormalized')
+            .values_list('ProdCode_Value', flat=True)[:limit]
+        )
+        if len(codes) > 0:
+            return codes
+    return []
+
+
+def _prefix_successor(prefix):
+    """The least string greater than every string that starts with ``prefix``."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
 
 
 class CertificationAgency(Model):
@@ -284,6 +408,32 @@ class User(auth.models.AbstractUser):
     pass
 
 
+class EditQuerySet(models.QuerySet):
+    def with_values(self):
+        """Join every typed edit table so FieldValue never needs another query."""
+        return self.select_related(*EDIT_VALUE_ACCESSORS)
+
+    def pending_updates(self):
+        return self.filter(Status=Edit.StatusChoice.Pending.value,
+                           Type=Edit.TypeChoice.Update.value)
+
+    def latest_pending_updates(self):
+        """The latest pending Update edit of each (ModelName, InstanceID, FieldName).
+
+        An edit is the latest if no other pending Update of the same field was
+        submitted after it, which the ``edit_field_latest_idx`` index answers
+        with a single seek per edit.
+        """
+        newer = Edit.objects.pending_updates().filter(
+            Q(DateSubmitted__gt=OuterRef('DateSubmitted'))
+            | Q(DateSubmitted=OuterRef('DateSubmitted'), id__gt=OuterRef('id')),
+            ModelName=OuterRef('ModelName'),
+            InstanceID=OuterRef('InstanceID'),
+            FieldName=OuterRef('FieldName')
+        )
+        return self.pending_updates().filter(~Exists(newer))
+
+
 class Edit(models.Model):
     StatusChoice = enum.Enum('Statuses', {s: s[0] for s in ('Approved', 'Pending', 'Rejected')})
     TypeChoice = enum.Enum('Types', {t: t[0] for t in ('Addition', 'Update', 'Deletion')})
@@ -298,6 +448,30 @@ class Edit(models.Model):
     DateEffective = models.DateTimeField(blank=True, null=True)
     SubmittedBy = models.ForeignKey(auth.get_user_model(), related_name='edits_submittedby_set', on_delete=models.DO_NOTHING)
     ApprovedBy = models.ForeignKey(auth.get_user_model(), related_name='edits_approvedby_set', on_delete=models.DO_NOTHING, blank=True, null=True)
+    ValueType = models.CharField(choices=[(m, m) for m in EDIT_MODELS], max_length=max(len(m) for m in EDIT_MODELS), blank=True, editable=False)
+
+    objects = EditQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['ModelName', 'InstanceID', 'FieldName', 'DateSubmitted'],
+                         name='edit_field_latest_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.__class__ is not Edit:
+            self.ValueType = self.__class__.__name__
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if settings.MATERIALIZE_PENDING_EDITS:
+                PendingEdit.refresh(self.ModelName, self.InstanceID, self.FieldName)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            if settings.MATERIALIZE_PENDING_EDITS:
+                PendingEdit.refresh(self.ModelName, self.InstanceID, self.FieldName)
+        return result
 
     @property
     def FieldValue(self):
@@ -308,9 +482,15 @@ class Edit(models.Model):
         return self._subclass().FieldValueOld
 
     def _subclass(self):
+        if self.__class__ is not Edit:
+            return self
+        if self.ValueType != '':
+            return getattr(self, self.ValueType.lower())
         match self:
             case Edit(editchar=s):
                 return s
+            case Edit(editdate=s):
+                return s
             case Edit(editdatetime=s):
                 return s
             case Edit(editdecimal=s):
@@ -330,6 +510,11 @@ class EditChar(Edit):
     FieldValueOld = models.CharField(max_length=obit.STR_LEN, blank=True)
 
 
+class EditDate(Edit):
+    FieldValue = models.DateField(blank=True, null=True)
+    FieldValueOld = models.DateField(blank=True, null=True)
+
+
 class EditDateTime(Edit):
     FieldValue = models.DateTimeField(blank=True, null=True)
     FieldValueOld = models.DateTimeField(blank=True, null=True)
@@ -362,3 +547,93 @@ class EditURL(Edit):
 class EditUUID(Edit):
     FieldValue = models.UUIDField(blank=True)
     FieldValueOld = models.UUIDField(blank=True)
+
+
+def edit_model_for_field(field):
+    """The typed Edit model holding values of the OB model field ``field``."""
+    match field:
+        case models.UUIDField():
+            return EditUUID
+        case models.DateTimeField():
+            return EditDateTime
+        case models.DateField():
+            return EditDate
+        case models.DecimalField():
+            return EditDecimal
+        case models.PositiveIntegerField():
+            return EditPositiveInteger
+        case models.IntegerField():
+            return EditInteger
+        case models.CharField() if any(isinstance(v, validators.URLValidator) for v in field.validators):
+            return EditURL
+        case _:
+            return EditChar
+
+
+class PendingEdit(models.Model):
+    """The latest pending Update edit of each field.
+
+    Only maintained while ``settings.MATERIALIZE_PENDING_EDITS`` is on, in
+    which case ``Edit.save`` and ``Edit.delete`` keep it current and the edit
+    overlay reads from it instead of resolving the latest edits itself. Use
+    ``manage.py rebuild_pending_edits`` after turning it on.
+    """
+    ModelName = models.CharField(choices=[(m, m) for m in OB_MODELS], max_length=max(len(m) for m in OB_MODELS))
+    InstanceID = models.PositiveBigIntegerField()
+    FieldName = models.CharField(max_length=obit.max_ob_object_element_name_length(*OB_MODELS))
+    Edit = models.OneToOneField(Edit, on_delete=models.CASCADE)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['ModelName', 'InstanceID', 'FieldName'],
+                                    name='pendingedit_field_unique'),
+        ]
+
+    @classmethod
+    def refresh(cls, model_name, instance_id, field_name):
+        key = dict(ModelName=model_name, InstanceID=instance_id, FieldName=field_name)
+        latest = Edit.objects.filter(**key).latest_pending_updates().first()
+        if latest is None:
+            cls.objects.filter(**key).delete()
+        else:
+            cls.objects.update_or_create(defaults=dict(Edit=latest), **key)
+
+    @classmethod
+    def rebuild(cls):
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(
+                cls(ModelName=e.ModelName, InstanceID=e.InstanceID, FieldName=e.FieldName, Edit=e)
+                for e in Edit.objects.latest_pending_updates().iterator()
+            )
+
+
+class ProductDocument(models.Model):
+    """The serialized representation of each product, without unconfirmed edits.
+
+    Only maintained while ``settings.MATERIALIZE_PRODUCT_DOCUMENTS`` is on, in
+    which case saves anywhere in a product's OB tree and imports keep it
+    current (see ``server.documents``), and the product endpoints read from it
+    instead of walking the OB tables. Use ``manage.py rebuild_product_documents``
+    after turning it on.
+    """
+    Product = models.OneToOneField(Product, on_delete=models.CASCADE, primary_key=True, related_name='document')
+    Document = models.JSONField(encoder=JSONEncoder)
+    DateUpdated = models.DateTimeField(auto_now=True)
+
+
+class ImportCheckpoint(models.Model):
+    """How far the import of a spreadsheet got, so an interrupted import can resume.
+
+    Saved in the same transaction as every chunk of imported rows and deleted
+    once the whole spreadsheet is imported.
+    """
+    SourceHash = models.CharField(max_length=64)  # of the spreadsheet file
+    Spec = models.CharField(max_length=obit.STR_LEN)
+    LastRow = models.PositiveIntegerField(default=0)
+    DateUpdated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['SourceHash', 'Spec'], name='importcheckpoint_source_unique'),
+        ]
@@ -1,9 +1,15 @@
+import dataclasses
 import enum
+import functools
+import hashlib
 import json
+import os
+import pickle
 import re
+import tempfile
 import uuid
 from pathlib import Path
-from typing import Iterable, Tuple
+from typing import Iterable, Optional, Tuple
 from dataclasses import dataclass
 
 from django.db import models
@@ -17,6 +23,8 @@ TIME_STR_LEN = 100
 DECIMAL_PLACES = 8
 DECIMAL_MAX_DIGITS = DECIMAL_PLACES * 3
 OB_TAXONOMY_FILEPATH = Path(__file__).parent / 'references' / 'Master-OB-OpenAPI.json'
+OB_TAXONOMY_INDEX_FILEPATH = OB_TAXONOMY_FILEPATH.with_suffix('.index.pickle')
+OB_TAXONOMY_INDEX_VERSION = 2
 
 
 def load_ob_taxonomy():
@@ -24,7 +32,20 @@ def load_ob_taxonomy():
         return json.load(f)
 
 
-OB_TAXONOMY = load_ob_taxonomy()
+@functools.cache
+def ob_taxonomy():
+    """The raw taxonomy JSON, parsed on first use only."""
+    return load_ob_taxonomy()
+
+
+def __getattr__(name):
+    if name == 'OB_TAXONOMY':
+        return ob_taxonomy()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def get_ref_schema(ref: str):
+    return ref.split('/')[-1]
 
 
 class TaxonomyElement(enum.Enum):
@@ -49,7 +70,143 @@ class OBType(enum.Enum):
     Array = enum.auto()
 
 
-ItemTypeName = enum.Enum('ItemTypeName', {n: n for n in OB_TAXONOMY['x-ob-item-types']})
+@dataclass(frozen=True)
+class SchemaEntry:
+    """Precompiled view of one schema in ``components/schemas``.
+
+    ``properties``, ``elements``, ``objects`` and ``arrays`` are only set for
+    OB objects, ``items`` only for OB arrays, and the ``description`` and
+    item type fields only for OB elements.
+    """
+    name: str
+    type: Optional[OBType]
+    superclass: Optional[str]
+    properties: Optional[Tuple[str]] = None
+    elements: Tuple[str] = ()
+    objects: Tuple[str] = ()
+    arrays: Tuple[Tuple[str, str]] = ()
+    items: Optional[str] = None
+    description: str = ''
+    item_type: str = ''
+    item_type_group: str = ''
+
+
+@dataclass(frozen=True)
+class TaxonomyIndex:
+    version: int
+    sha256: str
+    schemas: dict
+    array_usages: dict
+    item_types: dict
+    item_type_groups: dict
+
+
+def compile_ob_taxonomy(taxonomy: dict, sha256: str):
+    element_superclasses = tuple(t.value for t in TaxonomyElement)
+    schemas = {}
+    for name, defn in taxonomy['components']['schemas'].items():
+        match defn:
+            case {'allOf': [{'$ref': ref}, details]}:
+                superclass = get_ref_schema(ref)
+                if superclass in element_superclasses:
+                    schemas[name] = SchemaEntry(
+                        name, OBType.Element, superclass,
+                        description=details['description'],
+                        item_type=details['x-ob-item-type'],
+                        item_type_group=details['x-ob-item-type-group']
+                    )
+                else:
+                    props = details.get('properties', None)
+                    schemas[name] = SchemaEntry(
+                        name, OBType.Object, superclass,
+                        properties=None if props is None else tuple(sorted(props))
+                    )
+            case {'type': 'object'}:
+                props = defn.get('properties', None)
+                schemas[name] = SchemaEntry(
+                    name, OBType.Object, None,
+                    properties=None if props is None else tuple(sorted(props))
+                )
+            case {'type': 'array', 'items': {'$ref': ref}}:
+                schemas[name] = SchemaEntry(name, OBType.Array, None, items=get_ref_schema(ref))
+            case {'type': 'array'}:
+                schemas[name] = SchemaEntry(name, OBType.Array, None)
+            case _:
+                schemas[name] = SchemaEntry(name, None, None)
+
+    for name, entry in schemas.items():
+        if entry.properties is None:
+            continue
+        # Inline properties (e.g. the primitives of TaxonomyElement*) have no
+        # schema of their own and are left out of the typed groupings.
+        props = [schemas[p] for p in entry.properties if p in schemas]
+        schemas[name] = dataclasses.replace(
+            entry,
+            elements=tuple(p.name for p in props if p.type is OBType.Element),
+            objects=tuple(p.name for p in props if p.type is OBType.Object),
+            arrays=tuple((p.name, p.items) for p in props if p.type is OBType.Array)
+        )
+
+    array_usages = {}
+    for name, entry in schemas.items():
+        for _, singular in entry.arrays:
+            array_usages.setdefault(singular, set()).add(name)
+
+    return TaxonomyIndex(
+        version=OB_TAXONOMY_INDEX_VERSION,
+        sha256=sha256,
+        schemas=schemas,
+        array_usages={n: tuple(sorted(users)) for n, users in array_usages.items()},
+        item_types=taxonomy['x-ob-item-types'],
+        item_type_groups=taxonomy['x-ob-item-type-groups']
+    )
+
+
+def load_ob_taxonomy_index():
+    """Load the compiled taxonomy, rebuilding it if the JSON has changed.
+
+    The compiled index is pickled next to the taxonomy JSON and keyed by the
+    JSON's SHA-256, so editing the taxonomy invalidates it automatically. A
+    read-only install simply compiles the index in memory on every start.
+    """
+    raw = OB_TAXONOMY_FILEPATH.read_bytes()
+    sha256 = hashlib.sha256(raw).hexdigest()
+    try:
+        with open(OB_TAXONOMY_INDEX_FILEPATH, 'rb') as f:
+            index = pickle.load(f)
+        if index.version == OB_TAXONOMY_INDEX_VERSION and index.sha256 == sha256:
+            return index
+    except Exception:
+        # A missing, unreadable or stale index, e.g. pickled from classes
+        # that have since changed, is rebuilt.
+        pass
+
+    index = compile_ob_taxonomy(json.loads(raw), sha256)
+    tmp = ''
+    try:
+        fd, tmp = tempfile.mkstemp(dir=OB_TAXONOMY_INDEX_FILEPATH.parent, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # mkstemp creates the file readable by its owner only, while the web
+        # workers may run as another user than whoever compiled the index.
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, OB_TAXONOMY_INDEX_FILEPATH)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return index
+
+
+@functools.cache
+def ob_taxonomy_index():
+    return load_ob_taxonomy_index()
+
+
+def get_schema_entry(name) -> SchemaEntry:
+    return ob_taxonomy_index().schemas[name]
+
+
+ItemTypeName = enum.Enum('ItemTypeName', {n: n for n in ob_taxonomy_index().item_types})
 
 
 @dataclass(frozen=True)
@@ -92,56 +249,125 @@ class ItemTypeGroup:
     group: Tuple[str]
 
 
-@dataclass
-class OBElement:
+@dataclass(frozen=True, slots=True)
+class ElementDescriptor:
+    """The taxonomy facts about one OB element.
+
+    Descriptors are interned by ``ob_element_descriptor``, so every model and
+    serializer using an element shares one instance.
+    """
     name: str
     description: str
-    superclass: str
+    superclass: TaxonomyElement
     item_type: ItemType
-    item_type_group: ItemTypeGroup
+    item_type_group: Optional[ItemTypeGroup]
+    grouped_item_type: ItemType
+    item_type_has_enums: bool
+    item_type_has_units: bool
+    primitives: Tuple[Primitive]
+
+
+@functools.cache
+def ob_element_descriptor(name):
+    entry = get_schema_entry(name)
+    superclass = TaxonomyElement(entry.superclass)
+    item_type = json_to_item_type(entry.item_type)
+    item_type_group = json_to_item_type_group(entry.item_type_group)
+
+    def item_type_has_values(item_type_class):
+        nonempty_item_type_group = item_type_group is None or len(item_type_group.group) > 0
+        return (
+            item_type.__class__ is item_type_class
+            and len(item_type.values) > 0
+            and nonempty_item_type_group
+        )
+    has_enums = item_type_has_values(ItemTypeEnum)
+    has_units = item_type_has_values(ItemTypeUnit)
+
+    grouped_item_type = item_type
+    if item_type_group is not None and (has_enums or has_units):
+        grouped_item_type = item_type.__class__(
+            name=item_type.name,
+            description=item_type.description,
+            values=tuple(v for v in item_type.values if v.id in item_type_group.group)
+        )
+
+    match superclass:
+        case TaxonomyElement.Boolean | TaxonomyElement.String:
+            primitives = (Primitive.EndTime, Primitive.StartTime, Primitive.Value)
+        case TaxonomyElement.Integer:
+            primitives = (Primitive.EndTime, Primitive.StartTime, Primitive.Value)
+            if has_units:
+                primitives += (Primitive.Unit,)
+        case TaxonomyElement.Number:
+            primitives = (Primitive.Decimals, Primitive.EndTime, Primitive.Precision,
+                          Primitive.StartTime, Primitive.Value)
+            if has_units:
+                primitives += (Primitive.Unit,)
+
+    return ElementDescriptor(
+        name=name,
+        description=entry.description,
+        superclass=superclass,
+        item_type=item_type,
+        item_type_group=item_type_group,
+        grouped_item_type=grouped_item_type,
+        item_type_has_enums=has_enums,
+        item_type_has_units=has_units,
+        primitives=primitives
+    )
+
+
+@dataclass(slots=True)
+class OBElement:
+    """An OB element as used by one model or serializer.
+
+    The taxonomy facts live in the shared ``descriptor``; an OBElement only
+    adds the field naming scheme and the ``Value`` field options of its use.
+    """
+    descriptor: ElementDescriptor
+    use_primitive_names: bool
+    Value_opts: dict
 
     def __init__(self, name, use_primitive_names=False, **Value_opts):
-        allOf = OB_TAXONOMY['components']['schemas'][name]
-        details = allOf['allOf'][1]
-
-        self.name = name
-        self.description = details['description']
-        self.superclass = TaxonomyElement(get_schema_superclass(name))
-        self.item_type = json_to_item_type(details['x-ob-item-type'])
-        self.item_type_group = json_to_item_type_group(details['x-ob-item-type-group'])
+        self.descriptor = ob_element_descriptor(name)
         self.use_primitive_names = use_primitive_names
         self.Value_opts = Value_opts
 
+    @property
+    def name(self):
+        return self.descriptor.name
+
+    @property
+    def description(self):
+        return self.descriptor.description
+
+    @property
+    def superclass(self):
+        return self.descriptor.superclass
+
+    @property
+    def item_type(self):
+        return self.descriptor.item_type
+
+    @property
+    def item_type_group(self):
+        return self.descriptor.item_type_group
+
     @property
     def grouped_item_type(self):
-        if self.item_type_group is None:
-            return self.item_type
-        kwargs = dict(
-            name=self.item_type.name,
-            description=self.item_type.description
-        )
-        if self.item_type_has_enums or self.item_type_has_units:
-            kwargs['values'] = tuple(v for v in self.item_type.values if v.id in self.item_type_group.group)
-        return self.item_type.__class__(**kwargs)
+        return self.descriptor.grouped_item_type
 
     @property
     def item_type_has_enums(self):
-        return self._item_type_has_values(ItemTypeEnum)
+        return self.descriptor.item_type_has_enums
 
     @property
     def item_type_has_units(self):
-        return self._item_type_has_values(ItemTypeUnit)
+        return self.descriptor.item_type_has_units
 
     def primitives(self):
-        match self.superclass:
-            case TaxonomyElement.Boolean:
-                return self._boolean_fields()
-            case TaxonomyElement.Integer:
-                return self._integer_fields()
-            case TaxonomyElement.Number:
-                return self._number_fields()
-            case TaxonomyElement.String:
-                return self._string_fields()
+        return self.descriptor.primitives
 
     def model_fields(self):
         return {self.model_field_name(p): self._primitive_field(p)
@@ -157,33 +383,6 @@ class OBElement:
             return p.name
         return f'{self.name} {p.name}'
 
-    def _item_type_has_values(self, item_type_class):
-        nonempty_item_type_group = self.item_type_group is None or len(self.item_type_group.group) > 0
-        return (
-            self.item_type.__class__ is item_type_class
-            and len(self.item_type.values) > 0
-            and nonempty_item_type_group
-        )
-
-    def _boolean_fields(self):
-        return [Primitive.EndTime, Primitive.StartTime, Primitive.Value]
-
-    def _integer_fields(self):
-        fields = [Primitive.EndTime, Primitive.StartTime, Primitive.Value]
-        if self.item_type_has_units:
-            fields.append(Primitive.Unit)
-        return fields
-
-    def _number_fields(self):
-        fields = [Primitive.Decimals, Primitive.EndTime, Primitive.Precision,
-                  Primitive.StartTime, Primitive.Value]
-        if self.item_type_has_units:
-            fields.append(Primitive.Unit)
-        return fields
-
-    def _string_fields(self):
-        return [Primitive.EndTime, Primitive.StartTime, Primitive.Value]
-
     def _primitive_field(self, primitive: Primitive):
         match primitive:
             case Primitive.Decimals:
@@ -224,8 +423,8 @@ class OBElement:
 
     def _Value_field(self):
         verbose_name = self.verbose_model_field_name(Primitive.Value)
-        if (fc := self.Value_opts.pop('field_class', None)) is not None:
-            return fc(verbose_name, **self.Value_opts)
+        if (fc := self.Value_opts.get('field_class', None)) is not None:
+            return fc(verbose_name, **{k: v for k, v in self.Value_opts.items() if k != 'field_class'})
         match self.superclass:
             case TaxonomyElement.Boolean:
                 field_kwargs = dict(blank=True, null=True)
@@ -312,8 +511,9 @@ class OBElement:
                 return models.CharField(verbose_name, **field_kwargs)
 
 
+@functools.cache
 def json_to_item_type(name: str):
-    it = OB_TAXONOMY['x-ob-item-types'][name]
+    it = ob_taxonomy_index().item_types[name]
     kwargs = dict(name=ItemTypeName(name), description=it['description'])
     match it:
         case {'enums': enums}:
@@ -328,85 +528,63 @@ def json_to_item_type(name: str):
             return ItemType(**kwargs)
 
 
+@functools.cache
 def json_to_item_type_group(name: str):
     if name == '':
         return None
-    itg = OB_TAXONOMY['x-ob-item-type-groups'][name]
+    itg = ob_taxonomy_index().item_type_groups[name]
     return ItemTypeGroup(itg['type'], itg['description'], tuple(itg['group']))
 
 
-def get_ref_schema(ref: str):
-    return ref.split('/')[-1]
-
-
 def get_schema_superclass(name: dict):
-    match get_schema_defn(name):
-        case {'allOf': [{'$ref': ref}, _]}:
-            return get_ref_schema(ref)
-        case _:
-            raise ValueError(f'"{name}" does not inherit from a superclass.')
+    superclass = get_schema_entry(name).superclass
+    if superclass is None:
+        raise ValueError(f'"{name}" does not inherit from a superclass.')
+    return superclass
 
 
 def get_schema_defn(name):
-    return OB_TAXONOMY['components']['schemas'][name]
+    return ob_taxonomy()['components']['schemas'][name]
 
 
 def get_schema_type(name):
-    match get_schema_defn(name):
-        case {'allOf': [{'$ref': ref}, _]}:
-            if get_ref_schema(ref) in tuple(t.value for t in TaxonomyElement):
-                return OBType.Element
-            return OBType.Object
-        case {'type': 'object'}:
-            return OBType.Object
-        case {'type': 'array'}:
-            return OBType.Array
-        case _:
-            raise ValueError(f'Unknown schema definition type: "{name}"')
+    schema_type = get_schema_entry(name).type
+    if schema_type is None:
+        raise ValueError(f'Unknown schema definition type: "{name}"')
+    return schema_type
+
+
+def _ob_object_entry(name):
+    entry = get_schema_entry(name)
+    if entry.properties is None:
+        raise ValueError(f'Unknown OB object schema: "{name}"')
+    return entry
 
 
 def ob_object_properties(name):
-    match get_schema_defn(name):
-        case {'allOf': [{'$ref': _}, {'properties': props}]}:
-            return props
-        case {'type': 'object', 'properties': props}:
-            return props
-        case _:
-            raise ValueError(f'Unknown OB object schema: "{name}"')
+    return _ob_object_entry(name).properties
 
 
 def elements_of_ob_object(name, **Element_Value_opts):
     return {n: OBElement(n, **Element_Value_opts.get(n, {}))
-            for n in sorted(ob_object_properties(name))
-            if get_schema_type(n) is OBType.Element}
+            for n in _ob_object_entry(name).elements}
 
 
 def objects_of_ob_object(name):
-    return tuple(n for n in sorted(ob_object_properties(name))
-                 if get_schema_type(n) is OBType.Object)
+    return _ob_object_entry(name).objects
 
 
 def arrays_of_ob_object(name):
-    return tuple((n, get_ref_schema(get_schema_defn(n)['items']['$ref']))
-                 for n in sorted(ob_object_properties(name))
-                 if get_schema_type(n) is OBType.Array)
+    return _ob_object_entry(name).arrays
 
 
 def ob_object_usage_as_array(name, user_schema_names):
-    uses = []
-    for uname in user_schema_names:
-        for array_name in ob_object_properties(uname):
-            match get_schema_defn(array_name):
-                case {'type': 'array', 'items': {'$ref': ref}}:
-                    if name == get_ref_schema(ref):
-                        uses.append(uname)
-                case _:
-                    continue
-    return tuple(sorted(uses))
+    return tuple(u for u in ob_taxonomy_index().array_usages.get(name, ())
+                 if u in user_schema_names)
 
 
 def max_ob_object_element_name_length(*args: Iterable[str]):
     return max(len(n) for n in set().union(*(
-        set(elements_of_ob_object(m)) for m in args
+        set(_ob_object_entry(m).elements) for m in args
         if get_schema_type(m) is OBType.Object
     )))
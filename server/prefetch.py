@@ -0,0 +1,55 @@
+from django.db.models import Prefetch
+
+import server.ob_item_types as obit
+from server import fieldsets
+from server import models
+
+
+def plan_queryset(queryset, fieldset=fieldsets.ALL):
+    """Load the whole OB tree of ``queryset`` the way the serializers walk it.
+
+    OB objects are one-to-one fields and are joined with ``select_related``;
+    OB arrays are reverse foreign keys and are fetched with one
+    ``prefetch_related`` query per array, whose queryset is planned in turn.
+    Multi-table subclasses of the model are joined through their reverse
+    one-to-one accessors so that e.g. a Product's ProdBattery part and
+    everything under it come along. Serializing a page then costs a fixed
+    number of queries however many rows it holds. The OB objects and arrays
+    ``fieldset`` leaves out are not loaded at all.
+    """
+    select_related, prefetch_related = _plan(queryset.model, '', fieldset)
+    return queryset.select_related(*select_related).prefetch_related(*prefetch_related)
+
+
+def _plan(model, prefix, fieldset):
+    select_related, prefetch_related = _plan_ob_object(model._meta.object_name, prefix, fieldset)
+    for subclass in models.concrete_subclasses(model):
+        path = f'{prefix}{subclass._meta.model_name}'
+        select_related.append(path)
+        s, p = _plan(subclass, f'{path}__', fieldset)
+        select_related += s
+        prefetch_related += p
+    return select_related, prefetch_related
+
+
+def _plan_ob_object(model_name, prefix, fieldset):
+    select_related, prefetch_related = [], []
+    if obit.get_schema_type(model_name) is not obit.OBType.Object:
+        return select_related, prefetch_related
+    for o in obit.objects_of_ob_object(model_name):
+        child = fieldset.child(o)
+        if child is None:
+            continue
+        path = f'{prefix}{o}'
+        select_related.append(path)
+        s, p = _plan_ob_object(o, f'{path}__', child)
+        select_related += s
+        prefetch_related += p
+    for plural, singular in obit.arrays_of_ob_object(model_name):
+        child = fieldset.child(plural)
+        if child is None:
+            continue
+        path = f'{prefix}{singular.lower()}_set'
+        children = models.django_model(singular).objects.all()
+        prefetch_related.append(Prefetch(path, queryset=plan_queryset(children, child)))
+    return select_related, prefetch_related
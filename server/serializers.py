@@ -1,11 +1,26 @@
+import functools
+import operator
 from collections import OrderedDict
+from types import MappingProxyType
 
+from django.db import models as django_models
 from rest_framework import serializers
 
+from server import fieldsets
 from server import models
+from server.edits import EditOverlay
 from server import ob_item_types as obit
 
 
+# The serializer of every OB object, by name, filled in as they are defined.
+SERIALIZERS = {}
+
+# The most compiled plans kept of each kind. Plans are keyed by fieldsets,
+# which clients choose with ?fields= and ?depth=, so the least recently used
+# ones are dropped rather than kept for every fieldset ever asked for.
+PLAN_CACHE_SIZE = 1024
+
+
 class SerializerMetaclass(serializers.SerializerMetaclass):
     def __new__(cls, name, bases, attrs):
         if name != 'Serializer':
@@ -14,12 +29,15 @@ class SerializerMetaclass(serializers.SerializerMetaclass):
                     e = obit.OBElement(name, use_primitive_names=True)
                     for p in e.primitives():
                         attrs[p.name] = serializers.SerializerMethodField()
-                        attrs[f'get_{p.name}'] = lambda _, obj: getattr(obj, p.name)
+                        attrs[f'get_{p.name}'] = lambda _, obj, field_name=p.name: getattr(obj, field_name)
                 case _:
                     cls.add_ob_elements(name, attrs)
                     cls.add_ob_objects(name, attrs)
                     cls.add_ob_arrays(name, attrs)
-        return super().__new__(cls, name, bases, attrs)
+        serializer = super().__new__(cls, name, bases, attrs)
+        if name != 'Serializer':
+            SERIALIZERS[name] = serializer
+        return serializer
 
     @classmethod
     def add_ob_elements(cls, name, attrs):
@@ -36,11 +54,10 @@ class SerializerMetaclass(serializers.SerializerMetaclass):
         field_pairs = [(p.name, e.model_field_name(p)) for p in primitives]
 
         def get_ob_element(self, o):
+            edits = self._edits
             data = OrderedDict()
             for p, f in field_pairs:
-                data[p] = getattr(o, f)
-                if self.context['unconfirmed_edits']:
-                    data[p] = self.context['edits'].get(f, data[p])
+                data[p] = edits.get(f, getattr(o, f))
             return data
         return get_ob_element
 
@@ -55,12 +72,8 @@ class SerializerMetaclass(serializers.SerializerMetaclass):
 
     @classmethod
     def _ob_object_serializer(cls, obj_name):
-        serializer = eval(obj_name, globals(), locals())
-
         def get_ob_object(self, o):
-            context = self.context.copy()
-            context.pop('unconfirmed_edits', None)
-            return serializer(getattr(o, obj_name), context=self.context).data
+            return SERIALIZERS[obj_name](getattr(o, obj_name), context=self._level_context).data
 
         return get_ob_object
 
@@ -75,40 +88,53 @@ class SerializerMetaclass(serializers.SerializerMetaclass):
 
     @classmethod
     def _ob_array_serializer(cls, array_name_singular):
-        serializer = eval(array_name_singular, globals(), locals())
         src = f'{array_name_singular.lower()}_set'
 
         def get_ob_array(self, o):
-            context = self.context.copy()
-            context.pop('unconfirmed_edits', None)
-            return serializer(getattr(o, src), many=True, context=self.context).data
+            serializer = SERIALIZERS[array_name_singular]
+            return serializer(getattr(o, src), many=True, context=self._level_context).data
 
         return get_ob_array
 
 
+def level_context(context, model, ids):
+    """The read-only context shared by the serializers of the rows ``ids`` of ``model`` and everything under them.
+
+    The edit overlay of the rows is loaded into it if unconfirmed edits are
+    shown and no level above has loaded it yet.
+    """
+    if context['unconfirmed_edits'] and 'edit_overlay' not in context:
+        context = dict(context, edit_overlay=EditOverlay.load(model, ids))
+    if isinstance(context, MappingProxyType):
+        return context
+    return MappingProxyType(context)
+
+
+class ListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, django_models.Manager) else data
+        if self.context['unconfirmed_edits'] and 'edit_overlay' not in self.context:
+            iterable = list(iterable)
+            if len(iterable) > 0:
+                self._context = level_context(self.context, iterable[0].__class__, (o.pk for o in iterable))
+        return super().to_representation(iterable)
+
+
 class Serializer(serializers.Serializer, metaclass=SerializerMetaclass):
+    class Meta:
+        list_serializer_class = ListSerializer
+
     def to_representation(self, o):
-        if self.context['unconfirmed_edits']:
-            edits = models.Edit.objects.raw(
-                """
-                SELECT id, server_Edit.FieldName FROM server_Edit JOIN (
-                    SELECT FieldName, max(DateSubmitted) as DateSubmitted FROM server_Edit
-                    GROUP BY FieldName
-                ) as latest_edits
-                ON server_Edit.DateSubmitted=latest_edits.DateSubmitted
-                AND server_Edit.FieldName=latest_edits.FieldName
-                WHERE server_Edit.ModelName=%s
-                AND server_Edit.InstanceID=%s
-                AND server_Edit.Status=%s
-                AND server_Edit.Type=%s;
-                """,
-                params=(
-                    o.__class__.__name__, o.id,
-                    models.Edit.StatusChoice.Pending.value,
-                    models.Edit.TypeChoice.Update.value
-                )
-            )
-            self.context['edits'] = {e.FieldName: e.FieldValue for e in edits}
+        return self.represent(o, level_context(self.context, o.__class__, [o.pk]))
+
+    def represent(self, o, context):
+        # The pending edits of ``o`` are kept on the serializer rather than in
+        # the context, which is shared with the serializers of the OB objects
+        # and arrays under it.
+        self._level_context = context
+        self._edits = {}
+        if context['unconfirmed_edits']:
+            self._edits = context['edit_overlay'].edits_for(o.__class__.__name__, o.pk)
         return super().to_representation(o)
 
 
@@ -224,10 +250,6 @@ class ProdGlazing(Serializer):
     pass
 
 
-class ProdInverter(Serializer):
-    pass
-
-
 class ProdMeter(Serializer):
     pass
 
@@ -250,28 +272,241 @@ class ProdWire(Serializer):
 
 class Product(Serializer):
     def to_representation(self, o):
-        kwargs = dict(context=self.context)
-        match o:
-            case models.Product(prodbattery=p):
-                subclass = ProdBattery(p, **kwargs).data
-            case models.Product(prodcell=p):
-                subclass = ProdCell(p, **kwargs).data
-            case models.Product(prodcombiner=p):
-                subclass = ProdCombiner(p, **kwargs).data
-            case models.Product(prodenergystoragesystem=p):
-                subclass = ProdEnergyStorageSystem(p, **kwargs).data
-            case models.Product(prodinverter=p):
-                subclass = ProdInverter(p, **kwargs).data
-            case models.Product(prodmeter=p):
-                subclass = ProdMeter(p, **kwargs).data
-            case models.Product(prodmodule=p):
-                subclass = ProdModule(p, **kwargs).data
-            case models.Product(prodoptimizer=p):
-                subclass = ProdOptimizer(p, **kwargs).data
-            case models.Product(prodwire=p):
-                subclass = ProdWire(p, **kwargs).data
-            case models.Product():
-                subclass = OrderedDict()
-        superclass = super().to_representation(o)
-        subclass.update(superclass)
-        return subclass
+        p = o.subclass_instance()
+        context = level_context(self.context, p.__class__, [p.pk])
+        overlay = context.get('edit_overlay', None) if context['unconfirmed_edits'] else None
+        return render_product(o, p, overlay, context.get('fieldset', fieldsets.ALL))
+
+
+def render_product(o, p, overlay=None, fieldset=fieldsets.ALL):
+    """The representation of the product ``o``, whose subclass instance is ``p``.
+
+    Same as the serializers give, with the pending edits in ``overlay``
+    applied, but rendered by the compiled plans of ``serialization_plan``
+    and pruned to ``fieldset``.
+    """
+    data = {}
+    if p.__class__ is not models.Product:
+        data = serialization_plan(p.__class__.__name__, fieldset).render(p, overlay)
+    data.update(serialization_plan('Product', fieldset).render(o, overlay))
+    return data
+
+
+@functools.lru_cache(maxsize=PLAN_CACHE_SIZE)
+def serialization_plan(name, fieldset=fieldsets.ALL):
+    return SerializationPlan(name, fieldset)
+
+
+class SerializationPlan:
+    """What the serializer of an OB object outputs, compiled to attribute getters.
+
+    Renders an instance and everything under it straight to dicts, skipping
+    DRF's dispatch of every OB element through a SerializerMethodField. The
+    serializers stay the reference; a plan is compiled from the same OB
+    elements, objects and arrays and outputs them in the same order, less
+    the ones its fieldset leaves out.
+    """
+
+    def __init__(self, name, fieldset=fieldsets.ALL):
+        self.name = name
+        self.omit_empty = fieldset.omit_empty
+        serializer = SERIALIZERS[name]
+        # (output key, getter of the values, primitive names, model field names)
+        self.elements = []
+        # (output key, getter of the object or array manager, plan)
+        self.objects = []
+        self.arrays = []
+        if obit.get_schema_type(name) is obit.OBType.Element:
+            names = [p.name for p in obit.OBElement(name, use_primitive_names=True).primitives()]
+            names = [n for n in names if fieldset.includes(n)]
+            self.primitives = (_values_getter(names), names)
+            return
+        self.primitives = None
+        elements = getattr(serializer, 'ob_elements', None) or obit.elements_of_ob_object(name)
+        for e in elements.values():
+            if not fieldset.includes(e.name):
+                continue
+            names = fieldset.element(e.name, [p.name for p in e.primitives()])
+            fields = [e.model_field_name(p) for p in e.primitives() if p.name in names]
+            self.elements.append((e.name, _values_getter(fields), names, fields))
+        for o in getattr(serializer, 'ob_objects', None) or obit.objects_of_ob_object(name):
+            child = fieldset.child(o)
+            if child is not None:
+                self.objects.append((o, operator.attrgetter(o), serialization_plan(o, child)))
+        for plural, singular in getattr(serializer, 'ob_arrays', None) or obit.arrays_of_ob_object(name):
+            child = fieldset.child(plural)
+            if child is not None:
+                getter = operator.attrgetter(f'{singular.lower()}_set')
+                self.arrays.append((plural, getter, serialization_plan(singular, child)))
+
+    def render(self, o, overlay=None):
+        if self.primitives is not None:
+            getter, names = self.primitives
+            return self.element_data(names, getter(o))
+        edits = None if overlay is None else overlay.edits_for(self.name, o.pk)
+        data = {}
+        for key, getter, primitives, fields in self.elements:
+            values = getter(o)
+            if edits:
+                values = [edits.get(f, v) for f, v in zip(fields, values)]
+            data[key] = self.element_data(primitives, values)
+        for key, getter, plan in self.objects:
+            data[key] = plan.render(getter(o), overlay)
+        for key, getter, plan in self.arrays:
+            data[key] = [plan.render(item, overlay) for item in getter(o).all()]
+        return data
+
+    def element_data(self, primitives, values):
+        if self.omit_empty:
+            return {p: v for p, v in zip(primitives, values) if p == 'Value' or v not in (None, '')}
+        return dict(zip(primitives, values))
+
+
+def _values_getter(names):
+    """Get the attributes ``names`` of an object as a tuple, however many there are."""
+    if len(names) == 0:
+        return lambda o: ()
+    getter = operator.attrgetter(*names)
+    if len(names) == 1:
+        return lambda o: (getter(o),)
+    return getter
+
+
+def render_product_values(pks, unconfirmed_edits=False, fieldset=fieldsets.ALL):
+    """The representations of the products ``pks``, in order, built from ``values_list`` rows.
+
+    Same as ``render_product`` gives, but no model instance is created: each
+    OB object is read through the joins of its owner's query, and each OB
+    array with one more query per level, like ``prefetch.plan_queryset``
+    plans them.
+    """
+    pks = list(pks)
+    overlay = EditOverlay.load(models.Product, pks) if unconfirmed_edits else None
+    plan = product_values_plan(fieldset)
+    arrays = {}
+    products = {}
+    for row in models.Product.objects.filter(pk__in=pks).values_list(*plan.columns):
+        products[row[0]] = plan.build(row, overlay, arrays)
+    while len(arrays) > 0:
+        arrays = _fill_array_values(arrays, overlay)
+    return [products[pk] for pk in pks if pk in products]
+
+
+def _fill_array_values(arrays, overlay):
+    """Read the OB array items of ``arrays``, ``{(parent name, item plan): {parent pk: [lists]}}``.
+
+    Returns the arrays of the items in turn.
+    """
+    nested = {}
+    for (parent, item_plan), lists in arrays.items():
+        plan = values_plan(item_plan)
+        rows = (
+            models.django_model(item_plan.name).objects
+            .filter(**{f'{parent}__in': list(lists)})
+            .order_by('pk')
+            .values_list(parent, *plan.columns)
+        )
+        for row in rows:
+            data = plan.build(row, overlay, nested, 1)
+            for items in lists[row[0]]:
+                items.append(data)
+    return nested
+
+
+@functools.lru_cache(maxsize=PLAN_CACHE_SIZE)
+def values_plan(plan):
+    return ValuesPlan(plan)
+
+
+@functools.lru_cache(maxsize=PLAN_CACHE_SIZE)
+def product_values_plan(fieldset=fieldsets.ALL):
+    return ProductValuesPlan(fieldset)
+
+
+class ValuesPlan:
+    """A ``SerializationPlan`` laid out over the columns of a ``values_list`` row.
+
+    The columns are the row's pk, its OB element fields, then the columns of
+    each OB object, prefixed with the object's field name so that they are
+    read through a join.
+    """
+
+    def __init__(self, plan, prefix=''):
+        self.plan = plan
+        self.name = plan.name
+        self.primitives = None
+        self.elements = []
+        self.objects = []
+        self.arrays = [(key, (plan.name, array_plan)) for key, _, array_plan in plan.arrays]
+        self.columns = [f'{prefix}pk']
+        if plan.primitives is not None:
+            _, names = plan.primitives
+            self.primitives = names
+            self.columns += [f'{prefix}{n}' for n in names]
+            return
+        for key, _, primitives, fields in plan.elements:
+            self.elements.append((key, len(self.columns), primitives, fields))
+            self.columns += [f'{prefix}{f}' for f in fields]
+        for key, _, object_plan in plan.objects:
+            nested = ValuesPlan(object_plan, f'{prefix}{key}__')
+            self.objects.append((key, len(self.columns), nested))
+            self.columns += nested.columns
+
+    def build(self, row, overlay, arrays, start=0):
+        """Build the representation at ``row[start:]``, registering its arrays to fill in ``arrays``."""
+        pk = row[start]
+        if self.primitives is not None:
+            return self.plan.element_data(self.primitives, row[start + 1:start + 1 + len(self.primitives)])
+        edits = None if overlay is None else overlay.edits_for(self.name, pk)
+        data = {}
+        for key, offset, primitives, fields in self.elements:
+            values = row[start + offset:start + offset + len(fields)]
+            if edits:
+                values = [edits.get(f, v) for f, v in zip(fields, values)]
+            data[key] = self.plan.element_data(primitives, values)
+        for key, offset, nested in self.objects:
+            data[key] = nested.build(row, overlay, arrays, start + offset)
+        for key, site in self.arrays:
+            data[key] = []
+            arrays.setdefault(site, {}).setdefault(pk, []).append(data[key])
+        return data
+
+
+class ProductValuesPlan:
+    """The ``ValuesPlan`` of Product followed by those of its multi-table subclasses.
+
+    The subclass columns are read through the reverse one-to-one joins, and
+    the row's ModelName picks which of them a product uses, as
+    ``Product.subclass_instance`` does.
+    """
+
+    def __init__(self, fieldset=fieldsets.ALL):
+        self.product = ValuesPlan(serialization_plan('Product', fieldset))
+        self.columns = self.product.columns + ['ModelName']
+        self.subclasses = {}
+        for subclass in models.concrete_subclasses(models.Product):
+            plan = serialization_plan(subclass.__name__, fieldset)
+            plan = ValuesPlan(plan, f'{subclass._meta.model_name}__')
+            self.subclasses[subclass.__name__] = (len(self.columns), plan)
+            self.columns += plan.columns
+
+    def build(self, row, overlay, arrays):
+        data = {}
+        subclass = self.subclass_name(row)
+        if subclass is not None:
+            start, plan = self.subclasses[subclass]
+            data = plan.build(row, overlay, arrays, start)
+        data.update(self.product.build(row, overlay, arrays))
+        return data
+
+    def subclass_name(self, row):
+        model_name = row[len(self.product.columns)]
+        if model_name == models.Product.__name__:
+            return None
+        if model_name != '':
+            return model_name
+        # Rows saved before ModelName existed.
+        for name, (start, _) in self.subclasses.items():
+            if row[start] is not None:
+                return name
+        return None
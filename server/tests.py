@@ -1,3 +1,587 @@
-from django.test import TestCase
+import csv
+import datetime
+from decimal import Decimal
+import json
+import os
+from pathlib import Path
+import tempfile
+from unittest import mock
+import zipfile
 
-# Create your tests here.
+from django.db import IntegrityError, connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.utils.encoders import JSONEncoder
+
+import server.ob_item_types as obit
+from server import caching
+from server import documents
+from server import exports
+from server import fieldsets
+from server import models
+from server import serializers
+from server import uploads
+from server import views
+
+
+class TaxonomyIndexTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = Path(directory.name) / 'taxonomy.index.pickle'
+        patcher = mock.patch.object(obit, 'OB_TAXONOMY_INDEX_FILEPATH', self.path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_readable_by_everyone(self):
+        index = obit.load_ob_taxonomy_index()
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o644)
+        self.assertEqual(obit.load_ob_taxonomy_index(), index)
+
+    def test_stale_index_is_rebuilt(self):
+        # A pickle of a class that no longer exists fails with an ImportError.
+        self.path.write_bytes(b'cserver.no_such_module\nIndex\n.')
+        index = obit.load_ob_taxonomy_index()
+        self.assertEqual(index.sha256, obit.ob_taxonomy_index().sha256)
+        self.assertEqual(obit.load_ob_taxonomy_index(), index)
+
+
+def battery_row(i, **values):
+    """A row of the CEC battery list, with the columns in ``values`` replaced."""
+    row = {
+        'Manufacturer Name': f'Mfr{i % 3}',
+        'Brand1': 'brand',
+        'Model Number': f'B{i:05d}',
+        'Technology': 'Lithium-Ion',
+        'Description': 'desc',
+        'Certifying Entity': 'UL',
+        'Certification Date': '2020-01-02',
+        'Edition of UL 1973': 'Ed. 2 : 2018',
+        'Nameplate Energy Capacity': str(10 + i),
+        'Maximum Continuous Discharge Rate2': '3',
+    }
+    row.update(values)
+    return row
+
+
+def module_row(i, **values):
+    """A row of the CEC module list, with the columns in ``values`` replaced."""
+    row = {
+        'Manufacturer': f'Mfr{i % 3}',
+        'Model Number': f'M{i:05d}',
+        'Description': 'mono',
+        'Safety Certification': 'UL 1703',
+    }
+    row.update(values)
+    return row
+
+
+def write_sheet(path, spec, rows):
+    """Write ``rows``, dicts of column values, as a CSV file laid out as ``spec`` expects."""
+    columns = list(spec.columns.keys())
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for i in range(spec.header_rows):
+            writer.writerow([f'header {i}'])
+        for row in rows:
+            writer.writerow([row.get(c, '') for c in columns])
+    return path
+
+
+class SpreadsheetTestCase(TestCase):
+    """A test with a directory to write spreadsheets to."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.dir = Path(directory.name)
+
+    def battery_sheet(self, name, rows):
+        return write_sheet(self.dir / name, uploads.CEC_BATTERY, rows)
+
+    def import_batteries(self, rows):
+        uploads.import_spreadsheet(self.battery_sheet('batteries.csv', rows), uploads.CEC_BATTERY)
+
+    def import_modules(self, rows):
+        uploads.import_spreadsheet(write_sheet(self.dir / 'modules.csv', uploads.CEC_MODULE, rows), uploads.CEC_MODULE)
+
+
+class ImportSpreadsheetsTests(SpreadsheetTestCase):
+    def test_workers(self):
+        sheets = [
+            (self.battery_sheet('a.csv', [battery_row(i) for i in range(7)]), uploads.CEC_BATTERY),
+            (self.battery_sheet('b.csv', [battery_row(i) for i in range(7, 12)]), uploads.CEC_BATTERY),
+        ]
+        counts = uploads.import_spreadsheets(sheets, chunk_size=3, workers=2)
+        self.assertEqual(counts['created'], 12)
+        self.assertEqual(
+            sorted(models.ProdBattery.objects.values_list('ProdCode_Value', flat=True)),
+            [f'B{i:05d}' for i in range(12)]
+        )
+        self.assertFalse(models.ImportCheckpoint.objects.exists())
+
+    def test_workers_reader_failure(self):
+        broken = self.dir / 'broken.xlsx'
+        broken.write_text('not a workbook')
+        sheets = [
+            (self.battery_sheet('a.csv', [battery_row(i) for i in range(3)]), uploads.CEC_BATTERY),
+            (broken, uploads.CEC_BATTERY),
+        ]
+        with self.assertRaises(zipfile.BadZipFile):
+            uploads.import_spreadsheets(sheets, chunk_size=3, workers=2)
+
+    def test_incremental_edits(self):
+        uploads.import_spreadsheet(self.battery_sheet('a.csv', [battery_row(0)]), uploads.CEC_BATTERY)
+        changed = battery_row(0, **{
+            'Description': 'changed',
+            'Nameplate Energy Capacity': '12.5',
+            'Certification Date': '2021-03-04',
+        })
+        user = models.User.objects.create(username='importer')
+        counts = uploads.import_spreadsheet(self.battery_sheet('b.csv', [changed]), uploads.CEC_BATTERY,
+                                            incremental=True, submitted_by=user)
+        self.assertEqual(counts['updated'], 1)
+        battery = models.ProdBattery.objects.get()
+        self.assertEqual(battery.Description_Value, 'desc')
+        edits = {e.FieldName: e for e in models.Edit.objects.with_values()}
+        self.assertEqual(
+            {(n, e.ModelName, e.ValueType) for n, e in edits.items()},
+            {
+                ('Description_Value', 'Product', 'EditChar'),
+                ('EnergyCapacityNominal_Value', 'ProdBattery', 'EditDecimal'),
+                ('CertificationDate_Value', 'ProdCertification', 'EditDate'),
+            }
+        )
+        self.assertEqual(edits['EnergyCapacityNominal_Value'].FieldValue, Decimal('12.5'))
+        self.assertEqual(edits['CertificationDate_Value'].FieldValue, datetime.date(2021, 3, 4))
+        self.assertEqual(edits['CertificationDate_Value'].FieldValueOld, datetime.date(2020, 1, 2))
+
+        url = '/api/v1/product/B00000/'
+        for query, description, capacity, date in (
+            ('', 'desc', 10.0, '2020-01-02'),
+            ('?unconfirmed_edits=true', 'changed', 12.5, '2021-03-04'),
+        ):
+            data = self.client.get(url + query).json()
+            self.assertEqual(data['Description']['Value'], description)
+            self.assertEqual(data['EnergyCapacityNominal']['Value'], capacity)
+            self.assertEqual(data['ProdCertifications'][0]['CertificationDate']['Value'], date)
+
+    def test_rejected_rows(self):
+        path = self.battery_sheet('a.csv', [
+            battery_row(0),
+            battery_row(1, Technology='Unobtainium'),
+            battery_row(2, **{'Nameplate Energy Capacity': 'lots'}),
+            battery_row(3),
+        ])
+        report = self.dir / 'errors.csv'
+        counts = uploads.import_spreadsheet(path, uploads.CEC_BATTERY, chunk_size=2, error_report=report)
+        self.assertEqual(counts, {'created': 2, 'rejected': 2})
+        self.assertEqual(sorted(models.ProdBattery.objects.values_list('ProdCode_Value', flat=True)),
+                         ['B00000', 'B00003'])
+        with open(report, newline='') as f:
+            rejected = list(csv.DictReader(f))
+        # Data rows start after the 12 header rows of the CEC battery list.
+        self.assertEqual([r['row'] for r in rejected], ['14', '15'])
+        self.assertIn('BatteryChemistryType_Value', rejected[0]['errors'])
+        self.assertIn('Unobtainium', rejected[0]['errors'])
+        self.assertIn('EnergyCapacityNominal_Value', rejected[1]['errors'])
+        self.assertIn('decimal', rejected[1]['errors'])
+
+    def test_incremental_duplicate_rows(self):
+        path = self.battery_sheet('a.csv', [
+            battery_row(0),
+            battery_row(1),
+            battery_row(0, Description='again'),
+        ])
+        report = self.dir / 'errors.csv'
+        counts = uploads.import_spreadsheet(path, uploads.CEC_BATTERY, incremental=True, error_report=report)
+        self.assertEqual(counts, {'created': 2, 'rejected': 1})
+        self.assertEqual(models.ProdBattery.objects.get(ProdCode_Value='B00000').Description_Value, 'again')
+        with open(report, newline='') as f:
+            rejected = list(csv.DictReader(f))
+        self.assertEqual([r['row'] for r in rejected], ['13'])
+        self.assertIn('Superseded by row 15', rejected[0]['errors'])
+
+    def test_database_error_saves_rows_one_by_one(self):
+        path = self.battery_sheet('a.csv', [battery_row(i) for i in range(4)])
+        report = self.dir / 'errors.csv'
+        bulk_save_models = uploads.bulk_save_models
+
+        def refuse_b00002(records, *args, **kwargs):
+            if any(r['ProdBattery']['ProdCode_Value'] == 'B00002' for r in records):
+                raise IntegrityError('B00002 refused')
+            return bulk_save_models(records, *args, **kwargs)
+
+        with mock.patch.object(uploads, 'bulk_save_models', refuse_b00002):
+            counts = uploads.import_spreadsheet(path, uploads.CEC_BATTERY, error_report=report)
+        self.assertEqual(counts, {'created': 3, 'rejected': 1})
+        self.assertEqual(sorted(models.ProdBattery.objects.values_list('ProdCode_Value', flat=True)),
+                         ['B00000', 'B00001', 'B00003'])
+        with open(report, newline='') as f:
+            rejected = list(csv.DictReader(f))
+        self.assertEqual([(r['row'], r['errors']) for r in rejected], [('15', 'B00002 refused')])
+
+    def test_resume(self):
+        path = self.battery_sheet('a.csv', [battery_row(i) for i in range(7)])
+        save_chunk = uploads.save_chunk
+        saved = []
+
+        def interrupt_second_chunk(chunk, *args, **kwargs):
+            if len(saved) == 1:
+                raise KeyboardInterrupt
+            saved.append(chunk)
+            return save_chunk(chunk, *args, **kwargs)
+
+        with mock.patch.object(uploads, 'save_chunk', interrupt_second_chunk), self.assertRaises(KeyboardInterrupt):
+            uploads.import_spreadsheet(path, uploads.CEC_BATTERY, chunk_size=3)
+        checkpoint = models.ImportCheckpoint.objects.get()
+        self.assertEqual(checkpoint.LastRow, saved[0].last_row)
+        self.assertEqual(checkpoint.LastRow, 15)
+
+        counts = uploads.import_spreadsheet(path, uploads.CEC_BATTERY, chunk_size=3)
+        self.assertEqual(counts, {'created': 4})
+        self.assertEqual(sorted(models.ProdBattery.objects.values_list('ProdCode_Value', flat=True)),
+                         [f'B{i:05d}' for i in range(7)])
+        self.assertFalse(models.ImportCheckpoint.objects.exists())
+
+
+class ProductCacheTests(SpreadsheetTestCase):
+    url = '/api/v1/product/B00000/'
+
+    def setUp(self):
+        super().setUp()
+        caching.product_cache().clear()
+        self.import_batteries([battery_row(0)])
+        self.battery = models.ProdBattery.objects.get()
+
+    def test_hit(self):
+        response = self.client.get(self.url)
+        with self.assertNumQueries(0):
+            cached = self.client.get(self.url)
+        self.assertEqual(cached.json(), response.json())
+        self.assertEqual(cached['ETag'], response['ETag'])
+
+    def test_invalidated_on_write(self):
+        self.client.get(self.url)
+        certification = models.ProdCertification.objects.get()
+        certification.CertificationDate_Value = datetime.date(2021, 3, 4)
+        with self.captureOnCommitCallbacks(execute=True):
+            certification.save()
+        data = self.client.get(self.url).json()
+        self.assertEqual(data['ProdCertifications'][0]['CertificationDate']['Value'], '2021-03-04')
+
+    def test_invalidated_while_serializing(self):
+        retrieve_data = views.ProductViewSet.retrieve_data
+
+        def write_after_read(view, pk):
+            data = retrieve_data(view, pk)
+            models.Product.objects.filter(pk=pk).update(Description_Value='changed')
+            caching.invalidate_products([pk])
+            return data
+
+        with mock.patch.object(views.ProductViewSet, 'retrieve_data', write_after_read):
+            self.assertEqual(self.client.get(self.url).json()['Description']['Value'], 'desc')
+        self.assertEqual(self.client.get(self.url).json()['Description']['Value'], 'changed')
+
+    def test_evicted_generation_is_a_miss(self):
+        self.client.get(self.url)
+        caching.product_cache().delete(caching._generation_key(self.battery.pk))
+        models.Product.objects.filter(pk=self.battery.pk).update(Description_Value='changed')
+        data = self.client.get(self.url).json()
+        self.assertEqual(data['Description']['Value'], 'changed')
+
+    def test_invalidate_every_lookup(self):
+        urls = (self.url, self.url + '?fields=Description', f'/api/v1/product/{self.battery.ProductID_Value}/')
+        for url in urls:
+            self.client.get(url)
+        models.Product.objects.filter(pk=self.battery.pk).update(Description_Value='changed')
+        caching.invalidate_products([self.battery.pk])
+        for url in urls:
+            self.assertEqual(self.client.get(url).json()['Description']['Value'], 'changed')
+
+
+def as_json(data):
+    """``data`` as a client reads it, with the order of every object's keys kept."""
+    return json.loads(JSONEncoder().encode(data), object_pairs_hook=list)
+
+
+def drf_representation(o, unconfirmed_edits):
+    """The product ``o`` as the OB serializers themselves render it, the reference for the plans."""
+    p = o.subclass_instance()
+    context = serializers.level_context(dict(unconfirmed_edits=unconfirmed_edits), p.__class__, [p.pk])
+    data = {}
+    if p.__class__ is not models.Product:
+        subclass = serializers.SERIALIZERS[p.__class__.__name__](context=context)
+        data = subclass.represent(p, context)
+    product = serializers.Product(context=context)
+    data.update(serializers.Serializer.represent(product, o, context))
+    return data
+
+
+def pruned(data, fields):
+    """``data`` with only the ``fields`` of a fieldset, in the order the serializers output them."""
+    if fields is None:
+        return data
+    if isinstance(data, list):
+        return [pruned(d, fields) for d in data]
+    fields = dict(fields)
+    return {k: pruned(v, fields[k]) for k, v in data.items() if k in fields}
+
+
+class RenderingTests(SpreadsheetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.import_batteries([battery_row(0)])
+        self.import_modules([module_row(0)])
+        self.battery = models.ProdBattery.objects.get()
+        self.module = models.ProdModule.objects.get()
+        self.pks = [self.battery.pk, self.module.pk]
+        user = models.User.objects.create(username='editor')
+        certification = self.battery.prodcertification_set.get()
+        for model, model_name, instance_id, field_name, value in (
+            (models.EditChar, 'Product', self.battery.pk, 'Description_Value', 'edited battery'),
+            (models.EditDecimal, 'ProdBattery', self.battery.pk, 'EnergyCapacityNominal_Value', Decimal('12.5')),
+            (models.EditDate, 'ProdCertification', certification.pk, 'CertificationDate_Value',
+             datetime.date(2021, 3, 4)),
+            (models.EditChar, 'ProdCell', self.module.ProdCell.pk, 'CellColor_Value', 'Blue'),
+            (models.EditDecimal, 'Dimension', self.module.Dimension.pk, 'Height_Value', Decimal('1.5')),
+        ):
+            model.objects.create(
+                ModelName=model_name, InstanceID=instance_id, FieldName=field_name,
+                Status=models.Edit.StatusChoice.Pending.value, Type=models.Edit.TypeChoice.Update.value,
+                DateSubmitted=timezone.now(), SubmittedBy=user, FieldValue=value
+            )
+
+    def products(self):
+        return [models.Product.objects.get(pk=pk) for pk in self.pks]
+
+    def rendered(self, unconfirmed_edits, fieldset=fieldsets.ALL):
+        context = dict(unconfirmed_edits=unconfirmed_edits, fieldset=fieldset)
+        return {
+            'render_product': [as_json(serializers.Product(o, context=context).data) for o in self.products()],
+            'render_product_values': as_json(serializers.render_product_values(self.pks, unconfirmed_edits, fieldset)),
+        }
+
+    def assertSameRendering(self, rendered, expected):
+        for name, products in rendered.items():
+            with self.subTest(renderer=name):
+                self.assertEqual(products, expected)
+
+    def test_without_edits(self):
+        expected = [as_json(drf_representation(o, False)) for o in self.products()]
+        documents.refresh_documents(self.pks)
+        rendered = self.rendered(False)
+        rendered['ProductDocument'] = [
+            as_json(models.ProductDocument.objects.get(Product=pk).Document) for pk in self.pks
+        ]
+        self.assertSameRendering(rendered, expected)
+
+    def test_unconfirmed_edits(self):
+        expected = [as_json(drf_representation(o, True)) for o in self.products()]
+        self.assertNotEqual(expected, [as_json(drf_representation(o, False)) for o in self.products()])
+        self.assertSameRendering(self.rendered(True), expected)
+
+    def test_fieldset(self):
+        fieldset = fieldsets.Fieldset.parse(
+            'ProdCode,Description.Value,EnergyCapacityNominal,ProdCertifications.CertificationDate,'
+            'ProdCell.CellColor,Dimension.Height'
+        )
+        for unconfirmed_edits in (False, True):
+            expected = [pruned(drf_representation(o, unconfirmed_edits), fieldset.fields) for o in self.products()]
+            with self.subTest(unconfirmed_edits=unconfirmed_edits):
+                self.assertSameRendering(self.rendered(unconfirmed_edits, fieldset), as_json(expected))
+
+
+class ProdCodeLookupTests(SpreadsheetTestCase):
+    def setUp(self):
+        super().setUp()
+        caching.product_cache().clear()
+        self.import_batteries([
+            battery_row(0, **{'Model Number': 'RESU 10H'}),
+            battery_row(1, **{'Model Number': 'RESU-10H'}),
+            battery_row(2, **{'Model Number': 'ABC 123'}),
+        ])
+
+    def get(self, code):
+        return self.client.get(f'/api/v1/product/{code}/')
+
+    def assertCandidates(self, response, codes):
+        self.assertEqual(response.status_code, 300)
+        self.assertEqual(sorted(c['ProdCode'] for c in response.json()['candidates']), sorted(codes))
+
+    def test_exact_code(self):
+        for code in ('RESU 10H', 'RESU-10H'):
+            response = self.get(code)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()['ProdCode']['Value'], code)
+
+    def test_normalized_code(self):
+        response = self.get('abc-123')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['ProdCode']['Value'], 'ABC 123')
+
+    def test_ambiguous_normalized_code(self):
+        self.assertCandidates(self.get('resu10h'), ['RESU 10H', 'RESU-10H'])
+
+    def test_ambiguous_exact_code(self):
+        self.import_batteries([battery_row(3, **{'Model Number': 'ABC 123'})])
+        response = self.get('ABC 123')
+        self.assertCandidates(response, ['ABC 123', 'ABC 123'])
+        self.assertEqual(
+            {c['ProductID'] for c in response.json()['candidates']},
+            {str(i) for i in models.Product.objects.filter(ProdCode_Value='ABC 123').values_list('ProductID_Value', flat=True)}
+        )
+
+    def test_not_found(self):
+        response = self.get('RESU-10X')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(sorted(response.json()['suggestions']), ['RESU 10H', 'RESU-10H'])
+        self.assertEqual(self.get('---').status_code, 404)
+
+    @override_settings(MATERIALIZE_PRODUCT_DOCUMENTS=True)
+    def test_documents(self):
+        documents.rebuild_documents()
+        self.assertEqual(self.get('RESU 10H').json()['ProdCode']['Value'], 'RESU 10H')
+        self.assertCandidates(self.get('resu10h'), ['RESU 10H', 'RESU-10H'])
+
+    @override_settings(SERIALIZE_PRODUCT_VALUES=True)
+    def test_values(self):
+        self.assertEqual(self.get('RESU 10H').json()['ProdCode']['Value'], 'RESU 10H')
+        self.assertCandidates(self.get('resu10h'), ['RESU 10H', 'RESU-10H'])
+
+    def test_cached_code_becomes_ambiguous(self):
+        self.assertEqual(self.get('ABC 123').status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.import_batteries([battery_row(3, **{'Model Number': 'ABC-123'})])
+        self.assertEqual(self.get('ABC 123').status_code, 200)
+        self.assertCandidates(self.get('abc123'), ['ABC 123', 'ABC-123'])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.import_batteries([battery_row(4, **{'Model Number': 'ABC 123'})])
+        self.assertCandidates(self.get('ABC 123'), ['ABC 123', 'ABC 123'])
+
+
+class PlanCacheTests(TestCase):
+    def test_bounded(self):
+        for i in range(serializers.PLAN_CACHE_SIZE + 10):
+            fieldset = fieldsets.Fieldset.parse(f'junk{i}')
+            serializers.serialization_plan('Product', fieldset)
+            serializers.render_product_values([], fieldset=fieldset)
+        for plans in (serializers.serialization_plan, serializers.product_values_plan, serializers.values_plan):
+            with self.subTest(plans=plans.__name__):
+                info = plans.cache_info()
+                self.assertEqual(info.maxsize, serializers.PLAN_CACHE_SIZE)
+                self.assertLessEqual(info.currsize, info.maxsize)
+
+
+class ProductListQueriesTests(SpreadsheetTestCase):
+    """A page of products costs the same number of queries however many products it has."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = models.User.objects.create(username='editor')
+
+    def add_products(self, start, stop):
+        uploads.import_spreadsheet(self.battery_sheet(f'batteries{start}.csv',
+                                                      [battery_row(i) for i in range(start, stop)]),
+                                   uploads.CEC_BATTERY)
+        uploads.import_spreadsheet(write_sheet(self.dir / f'modules{start}.csv', uploads.CEC_MODULE,
+                                               [module_row(i) for i in range(start, stop)]),
+                                   uploads.CEC_MODULE)
+        for product in models.Product.objects.all():
+            models.EditChar.objects.create(
+                ModelName='Product', InstanceID=product.pk, FieldName='Description_Value',
+                Status=models.Edit.StatusChoice.Pending.value, Type=models.Edit.TypeChoice.Update.value,
+                DateSubmitted=timezone.now(), SubmittedBy=self.user, FieldValue='edited'
+            )
+
+    def page_queries(self, query=''):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/v1/product/?page_size=100' + query)
+        return len(response.json()['results']), len(queries)
+
+    def assertFixedQueries(self, query=''):
+        self.add_products(0, 3)
+        products, small_page = self.page_queries(query)
+        self.assertEqual(products, models.Product.objects.count())
+        self.add_products(3, 30)
+        with self.assertNumQueries(small_page):
+            products, _ = self.page_queries(query)
+        self.assertEqual(products, models.Product.objects.count())
+        self.assertGreater(products, 60)
+
+    def test_fixed_queries_per_page(self):
+        self.assertFixedQueries()
+
+    def test_fixed_queries_per_page_with_unconfirmed_edits(self):
+        self.assertFixedQueries('&unconfirmed_edits=true')
+        data = self.client.get('/api/v1/product/?page_size=100&unconfirmed_edits=true').json()
+        self.assertEqual({p['Description']['Value'] for p in data['results']}, {'edited'})
+
+
+class ProductListTests(SpreadsheetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.import_batteries([battery_row(i) for i in range(5)])
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_cursor_pagination(self):
+        page = self.get('/api/v1/product/?page_size=2').json()
+        self.assertEqual(len(page['results']), 2)
+        self.assertIsNone(page['previous'])
+        codes = []
+        while True:
+            codes += [p['ProdCode']['Value'] for p in page['results']]
+            if page['next'] is None:
+                break
+            self.assertIn('cursor=', page['next'])
+            page = self.get(page['next']).json()
+        self.assertEqual(codes, [f'B{i:05d}' for i in range(5)])
+
+    def test_page_size_limit(self):
+        with mock.patch('server.views.ProductCursorPagination.max_page_size', 3):
+            page = self.get('/api/v1/product/?page_size=100').json()
+        self.assertEqual(len(page['results']), 3)
+
+    def test_filter(self):
+        page = self.get('/api/v1/product/?ProdMfr=Mfr1').json()
+        self.assertEqual([p['ProdCode']['Value'] for p in page['results']], ['B00001', 'B00004'])
+        page = self.get('/api/v1/product/?ProdMfr=Mfr1&ProdCode=B00004').json()
+        self.assertEqual([p['ProdCode']['Value'] for p in page['results']], ['B00004'])
+
+    def export(self, query):
+        response = self.get('/api/v1/product/export/' + query)
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_export_ndjson(self):
+        response, content = self.export('')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = content.splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertEqual([json.loads(line)['ProdCode']['Value'] for line in lines], [f'B{i:05d}' for i in range(5)])
+        _, content = self.export('?ProdMfr=Mfr1')
+        self.assertEqual(len(content.splitlines()), 2)
+
+    def test_export_csv(self):
+        response, content = self.export('?export_format=csv')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        reader = csv.DictReader(content.splitlines())
+        self.assertEqual(reader.fieldnames, exports.product_csv_columns())
+        rows = {r['ProdCode.Value']: r for r in reader}
+        self.assertEqual(sorted(rows), [f'B{i:05d}' for i in range(5)])
+        row = rows['B00002']
+        self.assertEqual(row['ProdMfr.Value'], 'Mfr2')
+        self.assertEqual(row['BatteryChemistryType.Value'], 'LiIon')
+        self.assertEqual(Decimal(row['EnergyCapacityNominal.Value']), 12)
+        self.assertIn('Dimension.Height.Value', row)
+        certifications = json.loads(row['ProdCertifications'])
+        self.assertEqual([c['CertificationDate']['Value'] for c in certifications], ['2020-01-02'])
+
+    def test_export_bad_format(self):
+        response = self.client.get('/api/v1/product/export/?export_format=xml')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('export_format', response.json())
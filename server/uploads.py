@@ -1,15 +1,38 @@
-from collections import OrderedDict
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import csv
+import dataclasses
+from decimal import Decimal, InvalidOperation
+import functools
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
 from pathlib import Path
+import queue
 
-from django.apps import apps
-from django.db import transaction
-import flatten_json
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import DatabaseError, connections, router, transaction
+from django.utils import timezone
+import openpyxl
 import pandas as pd
 import numpy as np
 
+from server import caching
+from server import import_workers
+from server import models
+from server import prefetch
+
 
 DATA_DIR = Path(__file__).parent / 'data'
 BATTERY_XLSX = DATA_DIR / 'Battery_List_Data_ADA.xlsx'
+BULK_BATCH_SIZE = 500
+IMPORT_CHUNK_SIZE = 5000
+IMPORT_QUEUE_CHUNKS = 4
+READER_POLL_SECONDS = 1
 
 BATTERY_TO_OB_FIELD = OrderedDict([
     ('Manufacturer Name', 'ProdBattery.ProdMfr_Value'),
@@ -41,58 +64,683 @@ BATTERY_COLOMN_VALUE_TO_OB_VALUE = (
 )
 
 MODULE_TO_OB_FIELD = OrderedDict([
-    ('Manufacturer', 'ProdModule.Mfr'),
-    ('Model Number', 'ProdModule.ProdCode'),
-    ('Description', 'ProdModule.Description'),
-    ('Safety Certification', 'ProdModule.ProdCertification.CertificationTypeProduct_Value')
+    ('Manufacturer', 'ProdModule.ProdMfr_Value'),
+    ('Model Number', 'ProdModule.ProdCode_Value'),
+    ('Description', 'ProdModule.Description_Value'),
+    ('Safety Certification', 'ProdModule.ProdCertification.0.CertificationTypeProduct_Value')
 ])
 
 
+MODULE_COLUMN_VALUE_TO_OB_VALUE = (
+    ('Safety Certification', ('UL 1703', 'UL1703')),
+)
+
+
+@dataclasses.dataclass(frozen=True)
+class ImportSpec:
+    """How the rows of a CEC or vendor spreadsheet map to OB records.
+
+    ``name`` identifies the spec, ``columns`` maps the leading columns of the sheet, in order, to OB paths
+    (``None`` skips a column), ``values`` converts sheet values to OB values
+    per column, ``header_rows`` is the number of rows above the data, and
+    ``defaults`` sets OB paths of every record, e.g. to create the OB
+    objects a product requires.
+    """
+    name: str
+    columns: OrderedDict
+    values: tuple = ()
+    header_rows: int = 0
+    defaults: dict = dataclasses.field(default_factory=dict)
+
+
+CEC_BATTERY = ImportSpec(
+    name='cec_battery',
+    columns=BATTERY_TO_OB_FIELD,
+    values=BATTERY_COLOMN_VALUE_TO_OB_VALUE,
+    header_rows=12,
+    defaults={
+        'ProdBattery.Dimension.Height_Value': None,
+        'ProdBattery.DCInput.MPPTNumber_Value': None
+    }
+)
+CEC_MODULE = ImportSpec(
+    name='cec_module',
+    columns=MODULE_TO_OB_FIELD,
+    values=MODULE_COLUMN_VALUE_TO_OB_VALUE,
+    header_rows=18,
+    defaults={
+        'ProdModule.ProdCertification.0.CertificationAgency.CertificationAgencyName_Value': '',
+        'ProdModule.Dimension.Height_Value': None,
+        'ProdModule.ProdCell.Dimension.Height_Value': None,
+        'ProdModule.ProdGlazing.Height_Value': None
+    }
+)
+IMPORT_SPECS = {s.name: s for s in (CEC_BATTERY, CEC_MODULE)}
+
+
 def upload_cec_battery():
-    data = pd.read_excel(BATTERY_XLSX, header=None, names=BATTERY_TO_OB_FIELD.keys())[12:].replace({np.nan: None})
-    for col, (old_val, new_val) in BATTERY_COLOMN_VALUE_TO_OB_VALUE:
-        convert_val(data, col, old_val, new_val)
-    data = [row.to_dict() for _, row in data.iterrows()]
-    data = [{ob_path: row[cec_name] for cec_name, ob_path in BATTERY_TO_OB_FIELD.items() if ob_path is not None} for row in data]
-    for row in data:
-        row['ProdBattery.Dimension.Height_Value'] = None
-        row['ProdBattery.DCInput.MPPTNumber_Value'] = None
-    data = [flatten_json.unflatten_list(row, '.') for row in data]
-    with transaction.atomic():
-        for i, d in enumerate(data):
-            try:
-                save_model_from_dict('', d)
-            except Exception as e:
-                print(f'FAILED! At data entry {i} with the data:')
-                print(d)
-                print(f'Original error: {e}')
-                assert False, 'Import failed!'
+    return import_spreadsheet(BATTERY_XLSX, CEC_BATTERY)
+
+
+def import_spreadsheet(path, spec, chunk_size=IMPORT_CHUNK_SIZE, incremental=False, submitted_by=None,
+                       error_report=None, restart=False):
+    """Import the rows of the xlsx or CSV file at ``path`` as described by ``spec``.
+
+    See ``import_spreadsheets``.
+    """
+    return import_spreadsheets([(path, spec)], chunk_size, 1, incremental, submitted_by, error_report, restart)
+
+
+def import_spreadsheets(sheets, chunk_size=IMPORT_CHUNK_SIZE, workers=1, incremental=False, submitted_by=None,
+                        error_report=None, restart=False):
+    """Import ``(path, spec)`` spreadsheets, a chunk of ``chunk_size`` rows at a time.
+
+    Rows are validated against the model fields their values go to before
+    anything is saved. Each chunk of valid rows is committed in a
+    transaction of its own; when the database refuses a chunk, its rows are
+    saved one by one so only the offending rows are lost. Rejected rows are
+    counted and, given an ``error_report`` path, written to it as CSV.
+
+    The transaction of a chunk also records the last row it read in the
+    sheet's ImportCheckpoint. Importing the same file with the same spec
+    again, after an interruption, picks up after that row unless
+    ``restart`` is given. The checkpoint is deleted once the sheet is done.
+
+    With more than one of ``workers``, see ``_read_in_workers``. For
+    ``incremental`` and ``submitted_by``, see ``save_records``. Returns the
+    counts of created, updated, unchanged and rejected products.
+    """
+    checkpoints = {}
+    for path, spec in sheets:
+        checkpoint, _ = models.ImportCheckpoint.objects.get_or_create(SourceHash=file_sha256(path), Spec=spec.name)
+        if restart:
+            checkpoint.LastRow = 0
+        checkpoints[str(path)] = checkpoint
+    sheets = [(path, spec, checkpoints[str(path)].LastRow) for path, spec in sheets]
+    if workers == 1:
+        chunks = (c for path, spec, start_row in sheets
+                  for c in spreadsheet_chunks(path, spec, chunk_size, start_row))
+    else:
+        chunks = _read_in_workers(sheets, chunk_size, workers)
+    resuming = any(c.LastRow > 0 for c in checkpoints.values())
+    counts = Counter()
+    with contextlib.closing(chunks), ImportErrorReport(error_report, append=resuming) as report:
+        for chunk in chunks:
+            with transaction.atomic():
+                counts += save_chunk(chunk, incremental, submitted_by)
+                checkpoint = checkpoints[chunk.path]
+                checkpoint.LastRow = chunk.last_row
+                checkpoint.save()
+            report.write(chunk)
+    for checkpoint in checkpoints.values():
+        checkpoint.delete()
+    return counts
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while len(block := f.read(2 ** 20)) > 0:
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def _read_in_workers(sheets, chunk_size, workers):
+    """Yield the chunks of ``(path, spec, start row)`` sheets as ``workers`` processes read them.
+
+    Each sheet is streamed, normalized and validated by a worker process of
+    its own while the caller saves the chunks as they come in, so only the
+    database writes are serialized. When a reader fails, or its process
+    dies, its exception is raised here; the chunks saved before stay
+    committed and their checkpoints let the import resume.
+    """
+    # Spawned workers do not inherit this process's database connections.
+    context = multiprocessing.get_context('spawn')
+    chunks = context.Queue(maxsize=IMPORT_QUEUE_CHUNKS)
+    stop = context.Event()
+    with ProcessPoolExecutor(workers, context, initializer=import_workers.init_reader,
+                             initargs=(chunks, stop)) as pool:
+        readers = [pool.submit(import_workers.read_chunks, path, spec, chunk_size, start_row)
+                   for path, spec, start_row in sheets]
+        finished = 0
+        try:
+            while finished < len(readers):
+                try:
+                    chunk = chunks.get(timeout=READER_POLL_SECONDS)
+                except queue.Empty:
+                    _raise_reader_failure(readers)
+                    continue
+                if chunk is None:
+                    finished += 1
+                    continue
+                yield chunk
+            for r in readers:
+                r.result()
+        finally:
+            # Let the readers still running finish so the pool can shut down.
+            stop.set()
+            while finished < len(readers):
+                try:
+                    if chunks.get(timeout=READER_POLL_SECONDS) is None:
+                        finished += 1
+                except queue.Empty:
+                    if all(r.done() for r in readers):
+                        break
+
 
+def _raise_reader_failure(readers):
+    """Raise the exception of the first reader that failed, e.g. ``BrokenProcessPool`` if its process died."""
+    for r in readers:
+        if r.done() and r.exception() is not None:
+            raise r.exception()
 
-def django_model(model_name):
-    return apps.get_model('server', model_name)
 
+@dataclasses.dataclass
+class SpreadsheetChunk:
+    """Rows of a spreadsheet: the valid ones as OB records and the rejected ones with their errors."""
+    path: str
+    last_row: int
+    rows: list = dataclasses.field(default_factory=list)
+    records: list = dataclasses.field(default_factory=list)
+    rejected: list = dataclasses.field(default_factory=list)  # of (row, record, errors)
 
-def save_model_from_dict(model_name: str, d: dict):
-    fk_objs = {}
-    kwargs = {}
+
+def spreadsheet_chunks(path, spec, chunk_size=IMPORT_CHUNK_SIZE, start_row=0):
+    """Yield the rows of the spreadsheet at ``path`` as validated OB records, a chunk at a time."""
+    for data in read_spreadsheet(path, spec, chunk_size, start_row):
+        chunk = SpreadsheetChunk(str(path), int(data.index[-1]))
+        for row, record in zip(data.index, spec_records(data, spec)):
+            errors = validate_record(record)
+            if len(errors) > 0:
+                chunk.rejected.append((row, record, errors))
+            else:
+                chunk.rows.append(row)
+                chunk.records.append(record)
+        yield chunk
+
+
+def save_chunk(chunk, incremental=False, submitted_by=None):
+    """Save the valid rows of ``chunk`` in a savepoint, see ``import_spreadsheets``."""
+    if incremental:
+        reject_superseded_rows(chunk)
+    counts = Counter(rejected=len(chunk.rejected))
+    try:
+        with transaction.atomic():
+            return counts + save_records(chunk.records, incremental, submitted_by)
+    except DatabaseError:
+        pass
+    for row, record in zip(chunk.rows, chunk.records):
+        try:
+            with transaction.atomic():
+                counts += save_records([record], incremental, submitted_by)
+        except DatabaseError as e:
+            chunk.rejected.append((row, record, [str(e)]))
+            counts['rejected'] += 1
+    return counts
+
+
+def reject_superseded_rows(chunk):
+    """Move the rows of ``chunk`` that a later row of the same product supersedes to its rejected rows.
+
+    An incremental import matches products on their manufacturer and product
+    code, so of the rows of a chunk that share them only the last one is
+    saved; the others are reported rather than silently dropped.
+    """
+    keys = []
+    last = {}
+    for i, record in enumerate(chunk.records):
+        keys.append([(model_name, _product_key(d)) for model_name, d in record.items()])
+        for key in keys[-1]:
+            if key[1][1] != '':
+                last[key] = i
+    superseded = {j: last[key] for j, record_keys in enumerate(keys)
+                  for key in record_keys if last.get(key, j) != j}
+    if len(superseded) == 0:
+        return
+    rows, records = [], []
+    for j, (row, record) in enumerate(zip(chunk.rows, chunk.records)):
+        if j in superseded:
+            error = f'Superseded by row {chunk.rows[superseded[j]]}, which has the same ProdMfr and ProdCode.'
+            chunk.rejected.append((row, record, [error]))
+        else:
+            rows.append(row)
+            records.append(record)
+    chunk.rows, chunk.records = rows, records
+
+
+class ImportErrorReport:
+    """A CSV file of the rows rejected by an import, only created once a row is rejected.
+
+    With ``append``, e.g. when an import resumes, rows are added to an
+    existing report.
+    """
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.append = append
+        self._file = None
+        self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._file is not None:
+            self._file.close()
+
+    def write(self, chunk):
+        if self.path is None:
+            return
+        for row, record, errors in chunk.rejected:
+            if self._writer is None:
+                new = not (self.append and os.path.exists(self.path))
+                self._file = open(self.path, 'w' if new else 'a', newline='')
+                self._writer = csv.writer(self._file)
+                if new:
+                    self._writer.writerow(['sheet', 'row', 'errors', 'record'])
+            self._writer.writerow([chunk.path, row, '; '.join(errors), json.dumps(record, default=str)])
+
+
+def spec_records(chunk, spec):
+    """The OB records of a chunk of spreadsheet rows read for ``spec``."""
+    data = ob_columns(chunk, spec.columns, spec.values)
+    for ob_path, value in spec.defaults.items():
+        data[ob_path] = value
+    return ob_records(data)
+
+
+def validate_record(record):
+    """The problems with the values of an OB record, checked against the model fields they are for.
+
+    The fields are the ones ``OBElement`` generates, so this checks the OB
+    enum choices, lengths and ranges of every value before anything is
+    saved.
+    """
+    errors = []
+    for model_name, d in record.items():
+        _validate_values(models.django_model(model_name), d, model_name, errors)
+    return errors
+
+
+def _validate_values(model, d, path, errors):
     for k, v in d.items():
         if isinstance(v, list):
-            fk_objs[f'{k.lower()}_set'] = [save_model_from_dict(k, m) for m in v]
+            for i, item in enumerate(v):
+                _validate_values(models.django_model(k), item, f'{path}.{k}.{i}', errors)
         elif isinstance(v, dict):
-            submodel = save_model_from_dict(k, v)
-            kwargs[k] = submodel
+            _validate_values(models.django_model(k), v, f'{path}.{k}', errors)
         else:
-            kwargs[k] = v
-    if model_name != '':
-        new_model = django_model(model_name).objects.create(**kwargs)
-        if len(fk_objs) > 0:
-            for k, v in fk_objs.items():
-                getattr(new_model, k).set(v)
-                new_model.save()
-        return new_model
-    return kwargs
-
-
-def convert_val(df, col, old_val, val):
-    df.loc[df[col] == old_val, col] = val
+            try:
+                field = model._meta.get_field(k)
+                value = _field_value(field, v)
+                field.validate(value, None)
+                field.run_validators(value)
+            except FieldDoesNotExist:
+                errors.append(f'{path}.{k}: not a field of {model.__name__}')
+            except ValidationError as e:
+                errors.append(f'{path}.{k}: {" ".join(dict.fromkeys(e.messages))}')
+
+
+def read_spreadsheet(path, spec, chunk_size=IMPORT_CHUNK_SIZE, start_row=0):
+    """Yield the data rows after ``start_row`` of the xlsx or CSV file at ``path``, ``chunk_size`` rows at a time.
+
+    Neither format is loaded into memory as a whole: CSV files are read by
+    pandas in chunks and xlsx files are streamed with openpyxl's read-only
+    mode. Only the first sheet of a workbook is read. The DataFrames are
+    indexed by the row numbers in the sheet.
+    """
+    path = Path(path)
+    names = list(spec.columns.keys())
+    skip_rows = max(spec.header_rows, start_row)
+    if path.suffix.lower() == '.csv':
+        for chunk in pd.read_csv(path, header=None, skiprows=skip_rows, dtype=str, chunksize=chunk_size):
+            # Sheets may have more or, with trailing blanks trimmed, fewer columns than the spec.
+            chunk = chunk.reindex(columns=range(len(names)))
+            chunk.columns = names
+            chunk.index += skip_rows + 1
+            yield chunk
+        return
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(min_row=skip_rows + 1, values_only=True)
+        rows = ((i, r[:len(names)] + (None,) * (len(names) - len(r)))
+                for i, r in enumerate(rows, skip_rows + 1) if any(v is not None for v in r))
+        while len(chunk := list(itertools.islice(rows, chunk_size))) > 0:
+            yield pd.DataFrame([r for _, r in chunk], index=[i for i, _ in chunk], columns=names)
+    finally:
+        workbook.close()
+
+
+def ob_columns(data, column_to_ob_field, column_value_to_ob_value):
+    """The mapped columns of ``data``, renamed to their OB paths and with their values converted to OB values."""
+    data = data[[col for col, ob_path in column_to_ob_field.items() if ob_path is not None]]
+    values = {}
+    for col, (old_val, new_val) in column_value_to_ob_value:
+        values.setdefault(col, {})[old_val] = new_val
+    data = data.replace(values).rename(columns=column_to_ob_field)
+    return data.replace({np.nan: None})
+
+
+def ob_records(data):
+    """The nested OB record of every row of ``data``, whose columns are dotted OB paths.
+
+    The paths are parsed once into a template of the record, and each
+    record is filled in from the column values without looking at the
+    paths again.
+    """
+    template = ob_path_template(data.columns)
+    columns = [data[col].tolist() for col in data.columns]
+    return [_fill_template(template, row) for row in zip(*columns)]
+
+
+def ob_path_template(paths):
+    """Nest dotted OB paths like ``flatten_json.unflatten_list``, with the index of each path as its leaf.
+
+    ``['ProdBattery.ProdCode_Value', 'ProdBattery.ProdCertification.0.CertificationDate_Value']``
+    becomes ``{'ProdBattery': {'ProdCode_Value': 0, 'ProdCertification': [{'CertificationDate_Value': 1}]}}``.
+    """
+    template = {}
+    for i, path in enumerate(paths):
+        *parents, leaf = path.split('.')
+        node = template
+        for p in parents:
+            node = node.setdefault(p, {})
+        node[leaf] = i
+    return _arrays_to_lists(template)
+
+
+def _arrays_to_lists(node):
+    if not isinstance(node, dict):
+        return node
+    node = {k: _arrays_to_lists(v) for k, v in node.items()}
+    if all(k.isdigit() for k in node):
+        return [node[k] for k in sorted(node, key=int)]
+    return node
+
+
+def _fill_template(node, row):
+    if isinstance(node, dict):
+        return {k: _fill_template(v, row) for k, v in node.items()}
+    if isinstance(node, list):
+        return [_fill_template(v, row) for v in node]
+    return row[node]
+
+
+def save_records(records, incremental=False, submitted_by=None):
+    """Save the OB records of an import and count the created, updated and unchanged products.
+
+    Each product keeps the hash of the record it was imported from, which
+    an ``incremental`` import uses to only touch the products that changed,
+    see ``upsert_models``.
+    """
+    for record in records:
+        for model_name, d in record.items():
+            if issubclass(models.django_model(model_name), models.Product):
+                d.pop('SourceHash', None)
+                d['SourceHash'] = source_hash(d)
+    if incremental:
+        return upsert_models(records, submitted_by)
+    products = bulk_save_models(records)
+    caching.invalidate_on_commit({p.pk for p in products})
+    return Counter(created=len(records))
+
+
+def source_hash(d):
+    return hashlib.sha256(json.dumps(d, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def upsert_models(records, submitted_by=None, batch_size=BULK_BATCH_SIZE):
+    """Save product records, updating the products that were imported before.
+
+    Products are matched on their manufacturer and product code, and the
+    ones whose SourceHash matches their record are left alone. The others
+    are updated in place or, given the user ``submitted_by``, get a pending
+    Update edit for every changed value. New OB array items are inserted
+    either way, since edits only cover values. Products without a product
+    code are always created.
+    """
+    counts = Counter()
+    created = []
+    changes = _ProductChanges(submitted_by)
+    changed_products = set()
+    for model_name, ds in _records_by_model(records).items():
+        model = models.django_model(model_name)
+        by_key = {}
+        for d in ds:
+            key = _product_key(d)
+            if key[1] == '':
+                created.append({model_name: d})
+            else:
+                by_key[key] = d  # the last row of a product wins
+        stored = {
+            (mfr, code): (pk, h) for mfr, code, pk, h in
+            model.objects
+            .filter(ProdCode_Value__in={code for _, code in by_key})
+            .values_list('ProdMfr_Value', 'ProdCode_Value', 'pk', 'SourceHash')
+        }
+        changed = {}
+        for key, d in by_key.items():
+            if key not in stored:
+                created.append({model_name: d})
+            elif stored[key][1] == d['SourceHash']:
+                counts['unchanged'] += 1
+            else:
+                changed[stored[key][0]] = d
+        for instance in prefetch.plan_queryset(model.objects.filter(pk__in=changed)):
+            changes.add(instance, changed[instance.pk])
+            changed_products |= caching.products_containing(model_name, instance.pk)
+        counts['updated'] += len(changed)
+    changed_products |= {p.pk for p in bulk_save_models(created, batch_size)}
+    counts['created'] += len(created)
+    changes.save(batch_size)
+    # Bulk inserts and updates send no signals, so the cached responses and
+    # product documents are brought up to date here.
+    caching.invalidate_on_commit(changed_products)
+    return counts
+
+
+def _records_by_model(records):
+    by_model = {}
+    for record in records:
+        for model_name, d in record.items():
+            by_model.setdefault(model_name, []).append(d)
+    return by_model
+
+
+def _product_key(d):
+    return tuple('' if d.get(f) is None else str(d[f]) for f in ('ProdMfr_Value', 'ProdCode_Value'))
+
+
+class _ProductChanges:
+    """The differences between stored products and their newly imported records."""
+
+    def __init__(self, submitted_by):
+        self.submitted_by = submitted_by
+        self.updates = {}
+        self.edits = {}
+        self.levels = {}
+
+    def add(self, instance, d):
+        model = instance.__class__
+        for k, v in d.items():
+            if isinstance(v, list):
+                items = sorted(getattr(instance, f'{k.lower()}_set').all(), key=lambda o: o.pk)
+                parent = _Row(instance, 0)
+                attname = _array_parent_field(models.django_model(k), model).attname
+                for i, item in enumerate(v):
+                    if i < len(items):
+                        self.add(items[i], item)
+                    else:
+                        _plan_row(k, item, self.levels, 0).parent = (attname, parent)
+            elif isinstance(v, dict):
+                self.add(getattr(instance, k), v)
+            else:
+                field = model._meta.get_field(k)
+                old = getattr(instance, field.attname)
+                new = _field_value(field, v)
+                if new == old:
+                    continue
+                if self.submitted_by is None or field.name == 'SourceHash':
+                    setattr(instance, field.attname, new)
+                    objs, fields = self.updates.setdefault(field.model, ({}, set()))
+                    objs[instance.pk] = instance
+                    fields.add(field.name)
+                else:
+                    self._add_edit(instance, field, old, new)
+
+    def _add_edit(self, instance, field, old, new):
+        edit_model = models.edit_model_for_field(field)
+        self.edits.setdefault(edit_model, []).append(edit_model(
+            # Edits of inherited fields, e.g. the ProdCode of a ProdBattery,
+            # belong to the model declaring them, like the overlay looks them up.
+            ModelName=field.model.__name__,
+            InstanceID=instance.pk,
+            FieldName=field.name,
+            Status=models.Edit.StatusChoice.Pending.value,
+            Type=models.Edit.TypeChoice.Update.value,
+            DataSourceComment='Import',
+            DateSubmitted=timezone.now(),
+            SubmittedBy=self.submitted_by,
+            ValueType=edit_model.__name__,
+            FieldValue=new,
+            FieldValueOld=old
+        ))
+
+    def save(self, batch_size=BULK_BATCH_SIZE):
+        _insert_levels(self.levels, batch_size)
+        for model, (objs, fields) in self.updates.items():
+            if model is models.Product:
+                for o in objs.values():
+                    o.populate_derived_fields()
+                fields.update(models.Product.derived_fields)
+            model._base_manager.bulk_update(objs.values(), fields, batch_size=batch_size)
+        for edit_model, edits in self.edits.items():
+            bulk_insert(edit_model, edits, batch_size)
+            if settings.MATERIALIZE_PENDING_EDITS:
+                for e in edits:
+                    models.PendingEdit.refresh(e.ModelName, e.InstanceID, e.FieldName)
+
+
+def _field_value(field, v):
+    """The value a model field stores for an imported value ``v``."""
+    if v is None:
+        return field.get_default()
+    value = field.to_python(v)
+    if isinstance(value, Decimal):
+        try:
+            value = value.quantize(Decimal(1).scaleb(-field.decimal_places))
+        except InvalidOperation:
+            pass  # too many digits, which the field's validators report
+    return value
+
+
+def bulk_save_models(records, batch_size=BULK_BATCH_SIZE):
+    """Insert unflattened OB records, e.g. ``{'ProdBattery': {...}}``, a model at a time.
+
+    Every record is first planned as a tree of unsaved instances. A row's OB
+    objects have to be inserted before it, and its array items after it, so
+    each row is given a level that satisfies both. The levels are then
+    inserted in order with one ``bulk_create`` per model, filling in each
+    row's foreign keys from the rows inserted before it.
+    """
+    levels = {}
+    top = []
+    for record in records:
+        for model_name, d in record.items():
+            top.append(_plan_row(model_name, d, levels, 0))
+    _insert_levels(levels, batch_size)
+    return [row.instance for row in top]
+
+
+def _insert_levels(levels, batch_size=BULK_BATCH_SIZE):
+    for level in sorted(levels):
+        by_model = {}
+        for row in levels[level]:
+            row.link()
+            by_model.setdefault(row.instance.__class__, []).append(row.instance)
+        for model, objs in by_model.items():
+            bulk_insert(model, objs, batch_size)
+
+
+def bulk_insert(model, objs, batch_size=BULK_BATCH_SIZE):
+    """``bulk_create`` that also handles multi-table subclasses like ProdBattery.
+
+    ``bulk_create`` refuses models with a parent table, so their parent rows
+    are bulk created first and the subclass table's own columns are inserted
+    afterwards, pointing at them.
+    """
+    for o in objs:
+        if isinstance(o, models.Product):
+            o.populate_derived_fields()
+    parents = model._meta.get_parent_list()
+    if len(parents) == 0:
+        model.objects.bulk_create(objs, batch_size=batch_size)
+        return
+    assert len(parents) == 1, f'{model.__name__} has more than one parent table'
+    parent = parents[0]
+    parent_fields = [f for f in parent._meta.concrete_fields if not f.primary_key]
+    parent_objs = [parent(**{f.attname: getattr(o, f.attname) for f in parent_fields}) for o in objs]
+    parent.objects.bulk_create(parent_objs, batch_size=batch_size)
+    link = model._meta.get_ancestor_link(parent)
+    for o, p in zip(objs, parent_objs):
+        setattr(o, parent._meta.pk.attname, p.pk)
+        setattr(o, link.attname, p.pk)
+    db = router.db_for_write(model)
+    fields = model._meta.local_concrete_fields
+    batch_size = min(batch_size, connections[db].ops.bulk_batch_size(fields, objs))
+    for i in range(0, len(objs), batch_size):
+        model._base_manager.using(db)._insert(objs[i:i + batch_size], fields=fields)
+    for o in objs:
+        o._state.adding = False
+        o._state.db = db
+
+
+class _Row:
+    """An unsaved instance and the inserted rows its foreign keys point at."""
+
+    def __init__(self, instance, level):
+        self.instance = instance
+        self.level = level
+        self.objects = []
+        self.parent = None
+
+    def link(self):
+        for attname, row in self.objects:
+            setattr(self.instance, attname, row.instance.pk)
+        if self.parent is not None:
+            attname, row = self.parent
+            setattr(self.instance, attname, row.instance.pk)
+
+
+def _plan_row(model_name, d, levels, min_level):
+    model = models.django_model(model_name)
+    fields = {}
+    objects = []
+    arrays = []
+    for k, v in d.items():
+        if isinstance(v, list):
+            arrays.append((k, v))
+        elif isinstance(v, dict):
+            objects.append((k, v))
+        elif v is not None:
+            # Blank cells take the field's default, e.g. '' for text.
+            fields[k] = v
+    object_rows = [(model._meta.get_field(k).attname, _plan_row(k, v, levels, 0)) for k, v in objects]
+    row = _Row(model(**fields), max([min_level] + [r.level + 1 for _, r in object_rows]))
+    row.objects = object_rows
+    levels.setdefault(row.level, []).append(row)
+    for k, items in arrays:
+        attname = _array_parent_field(models.django_model(k), model).attname
+        for item in items:
+            item_row = _plan_row(k, item, levels, row.level + 1)
+            item_row.parent = (attname, row)
+    return row
+
+
+@functools.cache
+def _array_parent_field(model, parent):
+    """The foreign key of an OB array item ``model`` to its user ``parent``."""
+    for f in model._meta.concrete_fields:
+        if f.many_to_one and issubclass(parent, f.related_model):
+            return f
+    raise ValueError(f'{model.__name__} is not an OB array of {parent.__name__}')
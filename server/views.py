@@ -1,25 +1,236 @@
+from django.conf import settings
+from django.http import Http404, StreamingHttpResponse
 from django.shortcuts import render
-from rest_framework import viewsets
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework import exceptions, filters, pagination, status, viewsets
+from rest_framework.decorators import action
+from rest_framework.generics import get_object_or_404
+from rest_framework.response import Response
 
+from server import caching
+from server import exports
+from server import fieldsets
 from server import models
+from server import prefetch
 from server import serializers
 
 
+class ProductCursorPagination(pagination.CursorPagination):
+    """Keyset pagination, so deep pages cost the same as the first one."""
+    ordering = 'id'
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+
+
+class ProductFilter(filters.BaseFilterBackend):
+    """Exact-match filters on the indexed Product lookup columns."""
+    query_param_fields = {
+        'ProdMfr': 'ProdMfr_Value',
+        'ProdCode': 'ProdCode_Value',
+        'ProdType': 'ProdType_Value',
+        'ModelName': 'ModelName',
+    }
+
+    def filter_queryset(self, request, queryset, view):
+        lookups = {field: request.query_params[param]
+                   for param, field in self.query_param_fields.items()
+                   if param in request.query_params}
+        return queryset.filter(**lookups)
+
+
+class MultipleProducts(exceptions.APIException):
+    """More than one product matches a lookup, answered with the candidates to pick from."""
+    status_code = status.HTTP_300_MULTIPLE_CHOICES
+    default_detail = 'More than one product matches.'
+    default_code = 'multiple_products'
+
+
 class ProductViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = models.Product.objects.all()
     serializer_class = serializers.Product
+    pagination_class = ProductCursorPagination
+    filter_backends = [ProductFilter, filters.OrderingFilter]
+    ordering_fields = ['id', 'ProductID_Value']
+    ordering = ['id']
+    # The most products a MultipleProducts response lists.
+    max_candidates = 20
+
+    def get_queryset(self):
+        return prefetch.plan_queryset(super().get_queryset(), self.fieldset())
 
     def get_serializer_context(self):
         super_context = super().get_serializer_context()
-        query_params = self.request.query_params
-        context = dict(unconfirmed_edits=query_params.get('unconfirmed_edits', '') == 'true')
+        context = dict(unconfirmed_edits=self.unconfirmed_edits(), fieldset=self.fieldset())
         context.update(super_context)
         return context
 
+    def unconfirmed_edits(self):
+        return self.request.query_params.get('unconfirmed_edits', '') == 'true'
+
+    def fieldset(self):
+        """The OB elements, objects and arrays asked for with ``?fields=``, ``?depth=`` and ``?omit_empty=``."""
+        query_params = self.request.query_params
+        depth = query_params.get('depth', None)
+        if depth is not None:
+            if not depth.isdigit():
+                raise exceptions.ValidationError({'depth': 'Must be a non-negative integer.'})
+            depth = int(depth)
+        return fieldsets.Fieldset.parse(
+            query_params.get('fields', ''), depth, query_params.get('omit_empty', '') == 'true'
+        )
+
+    def serves_documents(self):
+        """Whether products are read from the ProductDocument table, which has whole products without edits."""
+        return (settings.MATERIALIZE_PRODUCT_DOCUMENTS and not self.unconfirmed_edits()
+                and self.fieldset() == fieldsets.ALL)
+
+    def list(self, request, *args, **kwargs):
+        if self.serves_documents():
+            queryset = models.Product.objects.select_related('document').only(*self.ordering_fields, 'document__Document')
+            render = self.product_documents
+        elif settings.SERIALIZE_PRODUCT_VALUES:
+            queryset = models.Product.objects.only(*self.ordering_fields)
+            render = self.product_values
+        else:
+            return super().list(request, *args, **kwargs)
+        queryset = self.filter_queryset(queryset)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(render(page))
+        return Response(render(queryset))
+
+    def product_values(self, products):
+        return serializers.render_product_values((p.pk for p in products), self.unconfirmed_edits(), self.fieldset())
+
+    def product_documents(self, products):
+        """The documents of ``products``, serializing the ones that have none yet."""
+        missing = [p.pk for p in products if not hasattr(p, 'document')]
+        serialized = {}
+        if len(missing) > 0:
+            serialized = {p.pk: self.get_serializer(p).data for p in self.get_queryset().filter(pk__in=missing)}
+        return [p.document.Document if hasattr(p, 'document') else serialized[p.pk] for p in products]
+
+    def retrieve(self, request, *args, **kwargs):
+        """Serve the product from the response cache, and 304 if the client's copy is current."""
+        lookup = self.lookup_value()
+        unconfirmed_edits = self.unconfirmed_edits()
+        fieldset = self.fieldset()
+        cached = caching.get_product(self.lookup_field, lookup, unconfirmed_edits, fieldset)
+        if cached is None:
+            pk = self.lookup_pk()
+            generation = caching.product_generation(pk)
+            data = self.retrieve_data(pk)
+            cached = caching.cache_product(pk, generation, self.lookup_field, lookup, unconfirmed_edits, data, fieldset)
+        response = Response(cached.data)
+        response['ETag'] = cached.etag
+        response['Last-Modified'] = http_date(cached.last_modified)
+        return get_conditional_response(
+            request, etag=cached.etag, last_modified=cached.last_modified, response=response
+        )
+
+    def retrieve_data(self, pk):
+        """The representation of the product ``pk``, from its document if there is one."""
+        if self.serves_documents():
+            document = models.ProductDocument.objects.filter(Product=pk).values_list('Document', flat=True).first()
+            if document is not None:
+                return document
+        if settings.SERIALIZE_PRODUCT_VALUES:
+            instance = self.lookup_object(models.Product.objects.only('pk'), pk)
+            return self.product_values([instance])[0]
+        instance = self.lookup_object(self.get_queryset(), pk)
+        return self.get_serializer(instance).data
+
+    def lookup_value(self):
+        return self.kwargs[self.lookup_url_kwarg or self.lookup_field]
+
+    def lookup_filters(self):
+        """The filters a product is looked up by, tried in turn until one matches."""
+        return [{self.lookup_field: self.lookup_value()}]
+
+    def lookup_pk(self):
+        """The id of the one product the first matching of ``lookup_filters`` finds.
+
+        Raises Http404 if none matches, and MultipleProducts, listing the
+        candidates, if more than one product matches the same filter.
+        """
+        products = self.filter_queryset(models.Product.objects.all())
+        for lookup in self.lookup_filters():
+            candidates = list(
+                products.filter(**lookup)
+                .order_by('pk')
+                .values_list('pk', 'ProdMfr_Value', 'ProdCode_Value', 'ProductID_Value')[:self.max_candidates + 1]
+            )
+            if len(candidates) == 1:
+                return candidates[0][0]
+            if len(candidates) > 1:
+                raise MultipleProducts({
+                    'detail': MultipleProducts.default_detail,
+                    'candidates': [
+                        {'ProdMfr': mfr, 'ProdCode': code, 'ProductID': str(product_id)}
+                        for _, mfr, code, product_id in candidates[:self.max_candidates]
+                    ],
+                })
+        raise Http404
+
+    def get_object(self):
+        return self.lookup_object(self.get_queryset(), self.lookup_pk())
+
+    def lookup_object(self, queryset, pk):
+        instance = get_object_or_404(queryset, pk=pk)
+        self.check_object_permissions(self.request, instance)
+        return instance
+
+    @action(detail=False)
+    def export(self, request):
+        """Stream every (filtered) product as NDJSON or as flattened CSV.
+
+        Products are read and serialized a chunk at a time, so memory stays
+        flat however large the registry is.
+        """
+        export_format = request.query_params.get('export_format', 'ndjson')
+        if export_format not in exports.EXPORT_FORMATS:
+            raise exceptions.ValidationError(
+                {'export_format': f'Must be one of: {", ".join(exports.EXPORT_FORMATS)}.'}
+            )
+        products = exports.serialized_products(
+            self.filter_queryset(models.Product.objects.all()),
+            self.get_serializer_context()
+        )
+        if export_format == 'csv':
+            rows = exports.csv_rows(products)
+        else:
+            rows = exports.ndjson_rows(products)
+        response = StreamingHttpResponse(rows, content_type=exports.EXPORT_FORMATS[export_format])
+        response['Content-Disposition'] = f'attachment; filename="products.{export_format}"'
+        return response
+
 
 class ProductByProdCodeViewSet(ProductViewSet):
+    """Products by product code, matched exactly or else normalized, so e.g. ``abc-123`` finds ``ABC 123``.
+
+    A code that more than one product has is answered with 300 Multiple
+    Choices and the candidates, and a code that matches no product with the
+    product codes that share the longest prefix with it, as suggestions.
+    """
     lookup_field = 'ProdCode_Value'
 
+    def lookup_filters(self):
+        code = self.lookup_value()
+        filters = [{'ProdCode_Value': code}]
+        normalized = models.normalize_prod_code(code)
+        if normalized != '':
+            filters.append({'ProdCodeNormalized': normalized})
+        return filters
+
+    def retrieve(self, request, *args, **kwargs):
+        try:
+            return super().retrieve(request, *args, **kwargs)
+        except Http404:
+            suggestions = models.similar_prod_codes(self.lookup_value())
+            raise exceptions.NotFound({'detail': 'Not found.', 'suggestions': suggestions})
+
 
 class ProductByProductIDVeiwSet(ProductViewSet):
     lookup_field = 'ProductID_Value'